@@ -0,0 +1,481 @@
+'''
+Caching for rendered ESI fragments.
+
+Fragments that send a ``Cache-Control`` header with ``max-age`` or
+``s-maxage`` are stored along with their headers and cookies, so the next page
+that includes them can use the stored copy instead of rendering the view again.
+Entries are keyed on the fragment URL and the values of the request headers
+the fragment names in its ``Vary`` header.
+
+Expired entries are kept for as long as the fragment's
+``stale-while-revalidate`` and ``stale-if-error`` directives allow, so they can
+be served while a fresh copy is rendered in the background or when rendering
+fails.  Entries with an ``ETag`` or ``Last-Modified`` header are also kept for
+ESI_REVALIDATION_WINDOW seconds, so the view can be asked whether they are
+still current with a conditional request.
+
+Keys are namespaced by ESI_CACHE_VERSION and by a generation number stored in
+the cache itself, so every process sharing the backend stops using the
+existing entries as soon as either changes; see invalidate_fragment_cache.
+The entries for a page's fragments are read with at most three ``get_many``
+calls and written with ``set_many``, so a page costs a fixed number of round
+trips to the backend however many fragments it has.
+
+Fragments can tag themselves with a space-separated ``Surrogate-Key`` header.
+Each key has a version in the cache, recorded in the entries tagged with it
+when they are stored; purge_surrogate_key gives the keys new versions, which
+drops every entry tagged with any of them.
+'''
+import hashlib
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.http import HttpResponse
+from django.utils.cache import cc_delim_re
+from django.utils.encoding import smart_str
+
+LOCAL_BACKEND = 'django.core.cache.backends.locmem.LocMemCache'
+KEY_PREFIX = 'armstrong.esi'
+
+# How long a background refresh may hold its lock before another one is
+# allowed to start.
+REFRESH_LOCK_TIMEOUT = 30
+# How long the generation number is kept.  Django's cache backends have no
+# portable way of storing a value forever.
+GENERATION_TIMEOUT = 30 * 24 * 60 * 60
+
+# Responses carrying any of these directives are never stored.  The fragment
+# cache is shared by every visitor, so it follows the rules for shared caches.
+UNCACHEABLE_DIRECTIVES = ('private', 'no-cache', 'no-store')
+
+# Directive arguments that can be sent without quotes.
+token_re = re.compile(r'^[\w.+-]+$')
+
+_backends = {}
+
+
+def parse_cache_control(value):
+    '''
+    Parses a Cache-Control header value into a dictionary of directives.
+
+    Directives without an argument, such as ``private``, map to True.
+    '''
+    directives = {}
+    for directive in cc_delim_re.split(value or ''):
+        if not directive:
+            continue
+        if '=' in directive:
+            name, argument = directive.split('=', 1)
+            directives[name.strip().lower()] = argument.strip().strip('"')
+        else:
+            directives[directive.strip().lower()] = True
+    return directives
+
+
+def format_cache_control(directives):
+    '''Formats a dictionary from parse_cache_control as a header value.'''
+    formatted = []
+    for name, value in sorted(directives.items()):
+        if value is True:
+            formatted.append(name)
+        elif token_re.match(value):
+            formatted.append('%s=%s' % (name, value))
+        else:
+            formatted.append('%s="%s"' % (name, value))
+    return ', '.join(formatted)
+
+
+def get_fragment_ttl(response):
+    '''
+    Returns the number of seconds the fragment response can be cached for, or
+    None if it can't be cached.
+    '''
+    if response.status_code != 200:
+        return None
+    if response.get('Vary', '').strip() == '*':
+        return None
+    directives = parse_cache_control(response.get('Cache-Control', None))
+    for directive in UNCACHEABLE_DIRECTIVES:
+        if directive in directives:
+            return None
+    # s-maxage applies to shared caches and takes precedence over max-age.
+    for directive in ('s-maxage', 'max-age'):
+        if directive in directives:
+            try:
+                ttl = int(directives[directive])
+            except ValueError:
+                return None
+            return ttl if ttl > 0 else None
+    return None
+
+
+def get_stale_windows(response):
+    '''
+    Returns the number of seconds after expiry that the response may be served
+    while it is refreshed and when refreshing it fails, as a tuple.
+
+    The fragment's ``stale-while-revalidate`` and ``stale-if-error``
+    directives take precedence over the ESI_STALE_WHILE_REVALIDATE and
+    ESI_STALE_IF_ERROR settings.
+    '''
+    directives = parse_cache_control(response.get('Cache-Control', None))
+    windows = []
+    for directive, setting in (
+            ('stale-while-revalidate', 'ESI_STALE_WHILE_REVALIDATE'),
+            ('stale-if-error', 'ESI_STALE_IF_ERROR')):
+        window = getattr(settings, setting, 0)
+        if directive in directives:
+            try:
+                window = int(directives[directive])
+            except ValueError:
+                pass
+        windows.append(max(window, 0))
+    return tuple(windows)
+
+
+def get_backend():
+    '''
+    Returns the Django cache backend named by ESI_CACHE_BACKEND, or a cache
+    local to this process if it isn't set.
+    '''
+    name = getattr(settings, 'ESI_CACHE_BACKEND', None)
+    if name not in _backends:
+        if name is None:
+            _backends[name] = get_cache(LOCAL_BACKEND, LOCATION=KEY_PREFIX)
+        else:
+            _backends[name] = get_cache(name)
+    return _backends[name]
+
+
+def get_fragment_cache():
+    '''Returns the FragmentCache to use, or None if caching is disabled.'''
+    if not getattr(settings, 'ESI_CACHE_FRAGMENTS', False):
+        return None
+    return FragmentCache(get_backend())
+
+
+def _hash(*parts):
+    return hashlib.md5(smart_str('\n'.join(parts))).hexdigest()
+
+
+def new_generation():
+    '''
+    Returns a generation number greater than any handed out before, so a
+    generation that was evicted from the cache never brings back the entries
+    written under an earlier one.
+    '''
+    return int(time.time() * 1000)
+
+
+def invalidate_fragment_cache():
+    '''Drops every cached fragment, in every process sharing the backend.'''
+    FragmentCache(get_backend()).next_generation()
+
+
+def purge_surrogate_key(*keys):
+    '''
+    Drops every cached fragment tagged with any of the surrogate keys, in
+    every process sharing the backend.
+    '''
+    FragmentCache(get_backend()).purge(keys)
+
+
+def get_surrogate_keys(response):
+    '''Returns the keys in the response's Surrogate-Key header.'''
+    return response.get('Surrogate-Key', '').split()
+
+
+def header_to_meta(header):
+    '''Converts a header name into its ``request.META`` key.'''
+    return 'HTTP_%s' % header.upper().replace('-', '_')
+
+
+class FragmentCache(object):
+    '''
+    Stores fragment responses in a Django cache backend.
+
+    ``request_headers`` is a mapping in the style of ``request.META`` holding
+    the headers the fragment request is made with.  It supplies the values of
+    the headers named in a fragment's ``Vary`` header.
+
+    An instance reads the generation number once and keeps it, and the
+    entries fetched by prefetch are kept by URL, so an instance should only be
+    used for the fragments of a single page request.
+    '''
+    def __init__(self, backend, version=None):
+        self.backend = backend
+        if version is None:
+            version = getattr(settings, 'ESI_CACHE_VERSION', 1)
+        self.namespace = '%s.v%s' % (KEY_PREFIX, version)
+        self.generation = None
+        self.prefetched = {}
+        self.pending = []
+        self.pending_lock = threading.Lock()
+
+    def generation_key(self):
+        return '%s.generation' % self.namespace
+
+    def load_generation(self, generation):
+        if generation is None:
+            self.backend.add(self.generation_key(), new_generation(),
+                GENERATION_TIMEOUT)
+            generation = self.backend.get(self.generation_key(), 0)
+        self.generation = generation
+
+    def next_generation(self):
+        '''Moves the namespace on to a new generation of keys.'''
+        current = self.backend.get(self.generation_key(), 0)
+        self.generation = max(current + 1, new_generation())
+        self.backend.set(self.generation_key(), self.generation,
+            GENERATION_TIMEOUT)
+
+    def surrogate_key(self, key):
+        return '%s.surrogate.%s' % (self.namespace, _hash(key))
+
+    def purge(self, keys):
+        '''Gives the surrogate keys new versions.'''
+        version = new_generation()
+        self.backend.set_many(dict((self.surrogate_key(key), version)
+            for key in keys), GENERATION_TIMEOUT)
+
+    def get_surrogate_versions(self, keys):
+        '''
+        Returns a dictionary of the current versions of the surrogate keys,
+        leaving out those that have none.
+        '''
+        keys = dict((self.surrogate_key(key), key) for key in set(keys))
+        if not keys:
+            return {}
+        values = self.backend.get_many(keys.keys())
+        return dict((keys[key], version) for key, version in values.items())
+
+    def vary_key(self, url):
+        return '%s.vary.%s' % (self.namespace, _hash(url))
+
+    def entry_key(self, url, vary, request_headers):
+        if self.generation is None:
+            self.load_generation(self.backend.get(self.generation_key()))
+        values = ['%s:%s' % (header.lower(),
+            request_headers.get(header_to_meta(header), '')) for header in vary]
+        return '%s.g%s.fragment.%s' % (self.namespace, self.generation,
+            _hash(url, *values))
+
+    def get_many(self, urls, request_headers):
+        '''
+        Returns a dictionary of the cache entries for those of urls that are
+        cached, using two round trips to the backend, and a third if any of
+        them are tagged with surrogate keys.
+        '''
+        vary_keys = dict((self.vary_key(url), url) for url in urls)
+        keys = vary_keys.keys()
+        if self.generation is None:
+            keys.append(self.generation_key())
+        values = self.backend.get_many(keys)
+        if self.generation is None:
+            self.load_generation(values.get(self.generation_key(), None))
+
+        entry_keys = {}
+        for vary_key, url in vary_keys.items():
+            vary = values.get(vary_key, None)
+            if vary is not None:
+                entry_keys[self.entry_key(url, vary, request_headers)] = url
+        if not entry_keys:
+            return {}
+        entries = self.backend.get_many(entry_keys.keys())
+
+        # Entries tagged with a key that has been purged since they were
+        # stored are treated as misses.
+        versions = self.get_surrogate_versions(key
+            for entry in entries.values()
+            for key in entry.get('surrogate_keys', {}))
+        return dict((entry_keys[key], entry) for key, entry in entries.items()
+            if all(versions.get(surrogate_key, None) == version for
+                surrogate_key, version in entry.get('surrogate_keys',
+                    {}).items()))
+
+    def prefetch(self, urls, request_headers):
+        '''
+        Fetches the entries for urls in one batch, so that calling get for
+        them doesn't go to the backend.
+        '''
+        urls = [url for url in urls if url not in self.prefetched]
+        if not urls:
+            return
+        entries = self.get_many(urls, request_headers)
+        for url in urls:
+            self.prefetched[url] = entries.get(url, None)
+
+    def get(self, url, request_headers):
+        '''
+        Returns the cache entry for the fragment, or None on a miss.
+
+        The entry may have expired; use is_fresh, can_serve_stale and
+        can_serve_on_error to decide what to do with it.
+        '''
+        if url in self.prefetched:
+            return self.prefetched[url]
+        return self.get_many([url], request_headers).get(url, None)
+
+    def set(self, url, request_headers, response, started=None):
+        '''
+        Stores the fragment response if its headers allow it.  started is
+        the time the fragment began rendering, used to tell whether one of
+        its surrogate keys was purged while it was rendered.
+        '''
+        self.set_many([(url, request_headers, response, started)])
+
+    def set_later(self, url, request_headers, response, started=None):
+        '''Stores the fragment response with the others at the next flush.'''
+        with self.pending_lock:
+            self.pending.append((url, request_headers, response, started))
+
+    def flush(self):
+        with self.pending_lock:
+            pending, self.pending = self.pending, []
+        if pending:
+            self.set_many(pending)
+
+    def set_many(self, items):
+        '''
+        Stores each (url, request_headers, response, started) item that its
+        headers allow, with one set_many call for each timeout.
+        '''
+        items = [item for item in items if get_fragment_ttl(item[2])]
+        versions = self.get_surrogate_versions(key
+            for item in items for key in get_surrogate_keys(item[2]))
+
+        values_by_timeout = {}
+        for url, request_headers, response, started in items:
+            surrogate_keys = {}
+            for key in get_surrogate_keys(response):
+                if key not in versions:
+                    self.backend.add(self.surrogate_key(key), 0,
+                        GENERATION_TIMEOUT)
+                    versions[key] = self.backend.get(self.surrogate_key(key),
+                        0)
+                surrogate_keys[key] = versions[key]
+            # Versions are the time of the purge in milliseconds, so a newer
+            # one means the key was purged after the fragment began rendering
+            # and the fragment may hold what was purged.
+            if started is not None and any(version > started * 1000
+                    for version in surrogate_keys.values()):
+                continue
+            vary = [header for header in
+                cc_delim_re.split(response.get('Vary', '')) if header]
+            # As in UpdateCacheMiddleware, a response that sets cookies for a
+            # request without any, and varies on Cookie, is likely setting up
+            # a session; storing it would key it on having no cookies and
+            # hand that session to every visitor who has none yet.
+            if response.cookies and \
+                    not request_headers.get('HTTP_COOKIE') and \
+                    'cookie' in [header.lower() for header in vary]:
+                continue
+            ttl = get_fragment_ttl(response)
+            stale_while_revalidate, stale_if_error = get_stale_windows(
+                response)
+            windows = [stale_while_revalidate, stale_if_error]
+            if response.has_header('ETag') or \
+                    response.has_header('Last-Modified'):
+                windows.append(getattr(settings, 'ESI_REVALIDATION_WINDOW',
+                    600))
+            timeout = ttl + max(windows)
+            entry = {
+                'content': response.content,
+                'status_code': response.status_code,
+                'headers': response.items(),
+                'cookies': response.cookies,
+                'vary': vary,
+                'stored': time.time(),
+                'expires': time.time() + ttl,
+                'stale_while_revalidate': stale_while_revalidate,
+                'stale_if_error': stale_if_error,
+                'surrogate_keys': surrogate_keys,
+            }
+            values = values_by_timeout.setdefault(timeout, {})
+            values[self.vary_key(url)] = vary
+            values[self.entry_key(url, vary, request_headers)] = entry
+        for timeout, values in values_by_timeout.items():
+            self.backend.set_many(values, timeout)
+
+    def lock_key(self, url, entry, request_headers):
+        return '%s.lock' % self.entry_key(url, entry['vary'], request_headers)
+
+    def acquire_refresh_lock(self, url, entry, request_headers):
+        '''
+        Returns True if the caller may refresh the entry.  Only one refresh of
+        an entry runs at a time, across every process sharing the backend.
+        '''
+        return self.backend.add(self.lock_key(url, entry, request_headers),
+            True, REFRESH_LOCK_TIMEOUT)
+
+    def release_refresh_lock(self, url, entry, request_headers):
+        self.backend.delete(self.lock_key(url, entry, request_headers))
+
+
+def is_fresh(entry, now=None):
+    return (now or time.time()) < entry['expires']
+
+
+def can_serve_stale(entry, now=None):
+    '''True while the expired entry may be served during a refresh.'''
+    return (now or time.time()) < \
+        entry['expires'] + entry['stale_while_revalidate']
+
+
+def can_serve_on_error(entry, now=None):
+    '''True while the expired entry may be served if rendering fails.'''
+    return (now or time.time()) < entry['expires'] + entry['stale_if_error']
+
+
+def conditional_headers(entry):
+    '''
+    Returns the If-None-Match and If-Modified-Since headers, keyed as in
+    ``request.META``, that ask the fragment view whether the entry is still
+    current.
+    '''
+    headers = {}
+    for header, value in entry['headers']:
+        if header.lower() == 'etag':
+            headers['HTTP_IF_NONE_MATCH'] = value
+        elif header.lower() == 'last-modified':
+            headers['HTTP_IF_MODIFIED_SINCE'] = value
+    return headers
+
+
+def revalidated_response(entry, not_modified):
+    '''
+    Returns the fragment response stored in entry, updated with the headers
+    of the 304 response that showed it is still current.
+    '''
+    response = HttpResponse(entry['content'], status=entry['status_code'])
+    for header, value in entry['headers']:
+        response[header] = value
+    for header, value in not_modified.items():
+        if header.lower() not in ('content-type', 'content-length'):
+            response[header] = value
+    response.cookies = not_modified.cookies or entry['cookies']
+    return response
+
+
+def response_from_entry(entry, now=None):
+    '''
+    Returns the fragment response stored in entry, with its max-age and
+    s-maxage lowered by the time it has spent in the cache.
+    '''
+    response = HttpResponse(entry['content'], status=entry['status_code'])
+    for header, value in entry['headers']:
+        response[header] = value
+    response.cookies = entry['cookies']
+    if 'stored' in entry and 'Cache-Control' in response:
+        age = int((now or time.time()) - entry['stored'])
+        directives = parse_cache_control(response['Cache-Control'])
+        for name in ('max-age', 's-maxage'):
+            try:
+                directives[name] = str(max(int(directives[name]) - age, 0))
+            except (KeyError, ValueError):
+                pass
+        response['Cache-Control'] = format_cache_control(directives)
+    return response
@@ -11,12 +11,14 @@ import os
 import re
 import mimetypes
 from Cookie import SimpleCookie
+from threading import Lock
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
 from django.conf import settings
+from django.core import exceptions
 from django.core.handlers.base import BaseHandler
 from django.core.handlers.wsgi import WSGIRequest
 from django.core.signals import got_request_exception
@@ -29,6 +31,9 @@ from django.utils.itercompat import is_iterable
 from django.db import transaction, close_connection
 
 BOUNDARY = 'BoUnDaRyStRiNg'
+# The request.META key that marks requests for ESI fragments.  It isn't an
+# HTTP_ key, so a client can't set it with a header.
+FRAGMENT_META = 'armstrong.esi.fragment'
 MULTIPART_CONTENT = 'multipart/form-data; boundary=%s' % BOUNDARY
 CONTENT_TYPE_RE = re.compile('.*; charset=([\w\d-]+);?')
 
@@ -57,20 +62,127 @@ class LocalHandler(BaseHandler):
     application code.
 
     Based on django.test.client.ClientHandler, with the CSRF hacks removed.
+
+    A single instance can be shared between threads.  The middleware is loaded
+    once and only reloaded if MIDDLEWARE_CLASSES changes.
     """
-    def __call__(self, environ):
-        from django.conf import settings
+    init_lock = Lock()
 
-        # Set up middleware if needed. We couldn't do this earlier, because
-        # settings weren't available.
-        if self._request_middleware is None:
-            self.load_middleware()
+    def __init__(self):
+        super(LocalHandler, self).__init__()
+        self._loaded_middleware_classes = None
+
+    def __call__(self, environ):
+        self.ensure_middleware_loaded()
 
         request = WSGIRequest(environ)
         response = self.get_response(request)
 
         return response
 
+    def get_middleware_classes(self):
+        return tuple(settings.MIDDLEWARE_CLASSES)
+
+    def ensure_middleware_loaded(self):
+        # Set up middleware if needed. We couldn't do this earlier, because
+        # settings weren't available.
+        middleware_classes = self.get_middleware_classes()
+        if self._loaded_middleware_classes == middleware_classes:
+            return
+        with self.init_lock:
+            if self._loaded_middleware_classes != middleware_classes:
+                self.load_middleware()
+                self._loaded_middleware_classes = middleware_classes
+
+class DirectHandler(LocalHandler):
+    """
+    A handler that calls views with an HttpRequest built by fragment_request
+    rather than a WSGI environ, and runs only the middleware listed in
+    ESI_FRAGMENT_MIDDLEWARE.
+    """
+    def __call__(self, request):
+        self.ensure_middleware_loaded()
+        return self.get_response(request)
+
+    def get_middleware_classes(self):
+        return tuple(getattr(settings, 'ESI_FRAGMENT_MIDDLEWARE', ()))
+
+    def load_middleware(self):
+        """
+        Populates the middleware lists as BaseHandler.load_middleware does,
+        from ESI_FRAGMENT_MIDDLEWARE rather than MIDDLEWARE_CLASSES.
+        """
+        self._view_middleware = []
+        self._template_response_middleware = []
+        self._response_middleware = []
+        self._exception_middleware = []
+
+        request_middleware = []
+        for middleware_path in self.get_middleware_classes():
+            try:
+                mw_module, mw_classname = middleware_path.rsplit('.', 1)
+            except ValueError:
+                raise exceptions.ImproperlyConfigured('%s isn\'t a middleware module' % middleware_path)
+            try:
+                mod = import_module(mw_module)
+            except ImportError, e:
+                raise exceptions.ImproperlyConfigured('Error importing middleware %s: "%s"' % (mw_module, e))
+            try:
+                mw_class = getattr(mod, mw_classname)
+            except AttributeError:
+                raise exceptions.ImproperlyConfigured('Middleware module "%s" does not define a "%s" class' % (mw_module, mw_classname))
+            try:
+                mw_instance = mw_class()
+            except exceptions.MiddlewareNotUsed:
+                continue
+
+            if hasattr(mw_instance, 'process_request'):
+                request_middleware.append(mw_instance.process_request)
+            if hasattr(mw_instance, 'process_view'):
+                self._view_middleware.append(mw_instance.process_view)
+            if hasattr(mw_instance, 'process_template_response'):
+                self._template_response_middleware.insert(0, mw_instance.process_template_response)
+            if hasattr(mw_instance, 'process_response'):
+                self._response_middleware.insert(0, mw_instance.process_response)
+            if hasattr(mw_instance, 'process_exception'):
+                self._exception_middleware.insert(0, mw_instance.process_exception)
+
+        # We only assign to this when initialization is complete as it is used
+        # as a flag for initialization being complete.
+        self._request_middleware = request_middleware
+
+# request.META keys describing the page request's body, which a fragment
+# request doesn't have.
+BODY_META = ('CONTENT_LENGTH', 'CONTENT_TYPE', 'wsgi.input')
+
+def fragment_request(path, cookies, meta):
+    """
+    Builds a GET request for path, with the cookies and the headers, keyed as
+    in request.META, of the page request that includes it.  The request is
+    marked as a fragment request with FRAGMENT_META.
+    """
+    parsed = urlparse(path)
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = request.path_info = urllib.unquote(parsed[2])
+    request.META = dict((key, value) for key, value in meta.items()
+        if key not in BODY_META)
+    request.META.update({
+        'PATH_INFO': request.path_info,
+        'QUERY_STRING': parsed[4],
+        'REQUEST_METHOD': 'GET',
+        FRAGMENT_META: True,
+    })
+    request.GET = QueryDict(parsed[4])
+    request.COOKIES = dict(cookies or {})
+    return request
+
+# The handlers used for fragment requests.  Sharing them means the middleware
+# chain is imported and instantiated once per process rather than once per
+# fragment.
+local_handler = LocalHandler()
+direct_handler = DirectHandler()
+
 def encode_multipart(boundary, data):
     """
     Encodes multipart POST data from a dictionary of form values.
@@ -148,8 +260,9 @@ class Client(object):
     contexts and templates produced by a view, rather than the
     HTML rendered to the end-user.
     """
-    def __init__(self, cookies=None, handler_class=LocalHandler, **defaults):
-        self.handler = handler_class()
+    def __init__(self, cookies=None, handler_class=LocalHandler, handler=None,
+            **defaults):
+        self.handler = handler or handler_class()
         self.defaults = {'SERVER_NAME': 'localserver'}
         self.defaults.update(defaults)
         self.cookies = SimpleCookie(cookies or {})
@@ -173,7 +286,8 @@ class Client(object):
         The master request method. Composes the environment dictionary
         and passes to the handler, returning the result of the handler.
         Assumes defaults for the query environment, which can be overridden
-        using the arguments to the request.
+        using the arguments to the request.  Requests are marked as fragment
+        requests with FRAGMENT_META.
         """
         environ = {
             'HTTP_COOKIE':       self.cookies.output(header='', sep='; '),
@@ -191,6 +305,7 @@ class Client(object):
             'wsgi.multiprocess': True,
             'wsgi.multithread':  False,
             'wsgi.run_once':     False,
+            FRAGMENT_META:       True,
         }
         environ.update(self.defaults)
         environ.update(request)
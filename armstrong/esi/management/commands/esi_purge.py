@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...cache import invalidate_fragment_cache, purge_surrogate_key
+
+
+class Command(BaseCommand):
+    args = '<surrogate key surrogate key ...>'
+    help = 'Drops the cached ESI fragments tagged with the surrogate keys.'
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+            help='Drop every cached ESI fragment.'),
+    )
+
+    def handle(self, *keys, **options):
+        if options['all']:
+            invalidate_fragment_cache()
+            return
+        if not keys:
+            raise CommandError('Give the surrogate keys to purge, or --all.')
+        purge_surrogate_key(*keys)
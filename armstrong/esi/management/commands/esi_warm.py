@@ -0,0 +1,182 @@
+from optparse import make_option
+import time
+from urlparse import urlsplit, urlunsplit
+from xml.etree import cElementTree
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import http_client
+from ...parser import parse
+from ...utils import FragmentAssembler, map_concurrently
+
+
+def default_host():
+    '''Returns the first host in ALLOWED_HOSTS that isn't a pattern.'''
+    for host in getattr(settings, 'ALLOWED_HOSTS', []):
+        if '*' not in host and not host.startswith('.'):
+            return host
+    return 'localhost'
+
+
+def local_path(url):
+    '''Returns the path and query of url, dropping the scheme and host.'''
+    parts = urlsplit(url.strip())
+    return urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+
+class Command(BaseCommand):
+    args = '<path path ...>'
+    help = ('Renders the pages at the paths, or in a sitemap, and stores the '
+        'ESI fragments they include in the fragment cache.')
+    option_list = BaseCommand.option_list + (
+        make_option('--sitemap', action='append', dest='sitemaps',
+            default=[], metavar='PATH',
+            help='Warm the pages listed in the sitemap at PATH.'),
+        make_option('--concurrency', type='int', dest='concurrency',
+            default=4, help='The number of pages or fragments rendered at '
+            'a time.'),
+        make_option('--host', dest='host', default=None,
+            help='The host the pages are requested for.  Defaults to the '
+            'first host in ALLOWED_HOSTS.'),
+        make_option('--header', action='append', dest='headers',
+            default=[], metavar='"NAME: VALUE"',
+            help='Send a header with every request, to warm the fragments '
+            'that vary on it.'),
+    )
+
+    def handle(self, *paths, **options):
+        if not getattr(settings, 'ESI_CACHE_FRAGMENTS', False):
+            raise CommandError('ESI_CACHE_FRAGMENTS is not set, so there is '
+                'no fragment cache to warm.')
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1.')
+        self.concurrency = options['concurrency']
+        self.headers = self.parse_headers(options['headers'])
+        self.headers['HTTP_HOST'] = options['host'] or default_host()
+
+        paths = list(paths)
+        for sitemap in options['sitemaps']:
+            paths.extend(self.sitemap_paths(local_path(sitemap)))
+        if not paths:
+            raise CommandError('Give the paths of the pages to warm, or '
+                '--sitemap.')
+        paths = sorted(set(local_path(path) for path in paths))
+
+        pages = map_concurrently(self.fetch_page, paths, self.concurrency)
+        self.warm([(path, content) for path, content in zip(paths, pages)
+            if content is not None])
+
+    def parse_headers(self, headers):
+        meta = {}
+        for header in headers:
+            if ':' not in header:
+                raise CommandError('Headers are given as "Name: value", not '
+                    '%r.' % header)
+            name, value = header.split(':', 1)
+            meta['HTTP_%s' % name.strip().upper().replace('-', '_')] = \
+                value.strip()
+        return meta
+
+    def get(self, path):
+        # Client requests are fragment requests, so the includes are left in
+        # the page.
+        client = http_client.Client(handler=http_client.local_handler,
+            **self.headers)
+        return client.get(path)
+
+    def fetch_page(self, path):
+        try:
+            response = self.get(path)
+        except Exception, e:
+            self.stderr.write('Skipping %s, which failed: %s\n' % (path, e))
+            return None
+        if response.status_code != 200:
+            self.stderr.write('Skipping %s, which returned status code %s\n' %
+                (path, response.status_code))
+            return None
+        return response.content
+
+    def sitemap_paths(self, path):
+        '''Returns the paths of the pages in a sitemap or sitemap index.'''
+        response = self.get(path)
+        if response.status_code != 200:
+            raise CommandError('The sitemap at %s returned status code %s.' %
+                (path, response.status_code))
+        root = cElementTree.fromstring(response.content)
+        locations = [element.text for element in root.getiterator()
+            if element.tag.endswith('loc') and element.text]
+        if root.tag.endswith('sitemapindex'):
+            paths = []
+            for location in locations:
+                paths.extend(self.sitemap_paths(local_path(location)))
+            return paths
+        return locations
+
+    def warm(self, pages):
+        '''
+        Renders the fragments included on pages, a list of (path, content)
+        tuples, through one FragmentAssembler so each is rendered once, and
+        reports the ones that failed or weren't stored.
+        '''
+        request = http_client.fragment_request(pages[0][0] if pages else '/',
+            {}, dict(self.headers, SERVER_NAME=self.headers['HTTP_HOST'],
+                SERVER_PORT='80'))
+        assembler = FragmentAssembler(request)
+        assembler.timings = []
+
+        keys = []
+        seen = set([None])
+        for path, content in pages:
+            for tag in parse(content):
+                key = assembler.include_key(tag, path)
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+
+        errors = []
+
+        def include(key):
+            # Failures are reported rather than stopping the warming.
+            try:
+                assembler.include(key)
+            except Exception, e:
+                errors.append((key[0], e))
+
+        started = time.time()
+        assembler.prefetch(keys)
+        try:
+            map_concurrently(include, keys, self.concurrency)
+        finally:
+            assembler.flush()
+
+        failed = set()
+        for url, e in errors:
+            self.stderr.write('%s failed: %s\n' % (url, e))
+            failed.add(url)
+        rendered = set()
+        cached = set()
+        for timing in assembler.timings:
+            url = timing['url']
+            if timing['status'] == 'timeout':
+                self.stderr.write('%s timed out\n' % url)
+                failed.add(url)
+            elif timing['status'] != 200:
+                self.stderr.write('%s returned status code %s\n' %
+                    (url, timing['status']))
+                failed.add(url)
+            elif timing['cache'] in ('hit', 'stale'):
+                cached.add(url)
+            else:
+                rendered.add(url)
+
+        # Only fragments whose headers allow it are stored.
+        entries = assembler.fragment_cache.get_many(rendered,
+            assembler.request_headers)
+        stored = set(url for url, entry in entries.items()
+            if entry['stored'] >= started)
+        for url in sorted(rendered - stored):
+            self.stderr.write('%s was rendered but not stored\n' % url)
+        self.stdout.write('Warmed %d fragments from %d pages: %d stored, %d '
+            'already cached, %d failed.\n' % (len(stored | cached),
+                len(pages), len(stored), len(cached), len(failed)))
@@ -1,20 +1,33 @@
 import hashlib
-import re
+import time
 
+from django.conf import settings
 from django.core.urlresolvers import resolve
-from django.core.cache import cache
 from django.http import HttpResponse
 
 from .utils import replace_esi_tags, gzip_response_content, \
-    gunzip_response_content
+    gunzip_response_content, is_fragment_request, is_streaming_response, \
+    merge_fragments, record_timing, server_timing_header, stream_esi_tags
 
 
-esi_tag_re = re.compile(r'<esi:include src="(?P<url>[^"]+?)"\s*/>', re.I)
-
 class IncludeEsiMiddleware(object):
     def process_response(self, request, response):
         esi_status = getattr(request, '_esi', {'used': False})
+        # Fragments the {% esi %} tag rendered inline are already in the
+        # content, but their headers and cookies still need merging.
+        if esi_status.get('inlined'):
+            merge_fragments(response, esi_status['inlined'])
         if not esi_status['used']:
+            if 'timings' in esi_status:
+                self.add_server_timing(response, esi_status['timings'])
+            return response
+        # Includes nested in a fragment are replaced by the page request that
+        # asked for the fragment.
+        if is_fragment_request(request):
+            return response
+
+        if is_streaming_response(response):
+            stream_esi_tags(request, response)
             return response
 
         # There is the possibility that GZipMiddleware has already been loaded by
@@ -25,17 +38,67 @@ class IncludeEsiMiddleware(object):
         # response to be compressed, decompressed, and then recompressed again.
         # Nine times out of ten, this is **not** what you want, but in the rare
         # instance that it is, this will continue to work as expected.
+        #
+        # With ESI_GZIP_SEGMENTS the page is instead recompressed a segment at a
+        # time, and segments compressed for earlier pages are reused.
         is_gzipped = response.get('Content-Encoding', None) == 'gzip'
         if is_gzipped:
+            started = time.time()
             gunzip_response_content(response)
+            record_timing(request, 'gunzip', started)
 
-        replace_esi_tags(request, response)
+        # A HEAD response has no body, so only the fragments' headers and
+        # cookies are needed.
+        if getattr(request, 'method', 'GET') == 'HEAD':
+            if replace_esi_tags(request, response, splice=False):
+                return self.not_modified(response, esi_status)
+            self.remove_content(response)
+            if is_gzipped:
+                response['Content-Encoding'] = 'gzip'
+            return self.finish(response, esi_status)
 
-        if is_gzipped:
-            gzip_response_content(request, response)
+        started = time.time()
+        if is_gzipped and getattr(settings, 'ESI_GZIP_SEGMENTS', False):
+            not_modified = replace_esi_tags(request, response, compress=True)
+            record_timing(request, 'assemble', started)
+            if not_modified:
+                return self.not_modified(response, esi_status)
+            response['Content-Encoding'] = 'gzip'
+            if response.has_header('Content-Length'):
+                response['Content-Length'] = str(len(response.content))
+        else:
+            not_modified = replace_esi_tags(request, response)
+            record_timing(request, 'assemble', started)
+            if not_modified:
+                return self.not_modified(response, esi_status)
+            if is_gzipped:
+                started = time.time()
+                gzip_response_content(request, response)
+                record_timing(request, 'gzip', started)
+        return self.finish(response, esi_status)
 
+    def finish(self, response, esi_status):
+        if 'timings' in esi_status:
+            self.add_server_timing(response, esi_status['timings'])
         return response
 
+    def remove_content(self, response):
+        response.content = ''
+        if response.has_header('Content-Length'):
+            del response['Content-Length']
+
+    def not_modified(self, response, esi_status):
+        '''Turns response into a 304 response, skipping assembly.'''
+        response.status_code = 304
+        self.remove_content(response)
+        return self.finish(response, esi_status)
+
+    def add_server_timing(self, response, timings):
+        value = server_timing_header(timings)
+        if response.has_header('Server-Timing'):
+            value = '%s, %s' % (response['Server-Timing'], value)
+        response['Server-Timing'] = value
+
 class EsiHeaderMiddleware(object):
     def process_response(self, request, response):
         if hasattr(request, '_esi'):
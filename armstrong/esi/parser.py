@@ -0,0 +1,234 @@
+'''
+Finds the ESI markup in a page.
+
+The markup handled is the subset of ESI 1.0 that Varnish processes:
+
+``<esi:include src="..." alt="..." onerror="continue" />``
+    Replaced with the fragment at ``src``.  If it fails, the fragment at
+    ``alt`` is used instead, and with ``onerror="continue"`` a failure leaves
+    the include empty rather than being treated as an error.
+
+``<esi:remove> ... </esi:remove>``
+    Removed along with everything inside it, which is only meant for clients
+    that don't process ESI.
+
+``<esi:comment text="..." />``
+    Removed.
+
+``<!--esi ... -->``
+    The comment delimiters are removed and the markup inside is processed.
+
+Pages are scanned once, with substring searches on a lowercased copy of the
+content rather than a regular expression, so the cost grows with the size of
+the page and the number of tags and nothing else.
+'''
+from collections import namedtuple
+import logging
+import re
+
+log = logging.getLogger('armstrong.esi')
+
+esi_tmpl = '<esi:include src="%s" />'
+
+ELEMENT_START = '<esi:'
+COMMENT_START = '<!--esi'
+COMMENT_END = '-->'
+REMOVE_END = '</esi:remove>'
+INCLUDE_END = '</esi:include>'
+SIMPLE_INCLUDE_START, SIMPLE_INCLUDE_END = esi_tmpl.split('%s')
+# The longest tag held back while streaming in case the rest of it arrives in
+# the next chunk.
+MAX_TAG_LENGTH = 4096
+
+element_name_re = re.compile(r'[\w-]+')
+attribute_re = re.compile(r'''([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+
+
+class Tag(namedtuple('Tag', 'start end src alt onerror')):
+    '''
+    A piece of ESI markup spanning content[start:end].  src is None for
+    markup that is only removed.
+    '''
+    __slots__ = ()
+
+    @property
+    def continue_on_error(self):
+        return self.onerror == 'continue'
+
+
+def parse_attributes(tag):
+    '''Returns the attributes of a tag's markup as a dictionary.'''
+    attributes = {}
+    for match in attribute_re.finditer(tag):
+        value = match.group(2)
+        if value is None:
+            value = match.group(3)
+        attributes[match.group(1).lower()] = value
+    return attributes
+
+
+def partial_tag_start(content, start=0):
+    '''
+    Returns the index from which the end of content could be the beginning of
+    ESI markup whose remainder hasn't been read yet, or len(content) if it
+    can't be.
+    '''
+    index = content.rfind('<', max(start, len(content) - MAX_TAG_LENGTH))
+    if index == -1 or '>' in content[index:]:
+        return len(content)
+    prefix = content[index:index + len(COMMENT_START)].lower()
+    if ELEMENT_START.startswith(prefix[:len(ELEMENT_START)]) or \
+            COMMENT_START.startswith(prefix):
+        return index
+    return len(content)
+
+
+class Scanner(object):
+    '''
+    Tokenizes content into Tags.
+
+    A single Scanner can be fed a document a piece at a time: whether the
+    scan is inside an ``<!--esi`` comment or an ``<esi:remove>`` element
+    carries over from one call to the next.
+    '''
+    def __init__(self):
+        self.in_comment = False
+        self.in_remove = False
+
+    def scan(self, content, final=True):
+        '''
+        Returns the Tags in content, in order, and the index up to which
+        content has been scanned.
+
+        Unless final is True, markup that may continue past the end of content
+        isn't returned; scanning stops at its start so it can be scanned again
+        with the content that follows.
+        '''
+        lowered = content.lower()
+        tags = []
+        position = 0
+        # The next occurrence of each marker, kept until the scan passes it so
+        # each marker is searched for once per occurrence rather than once per
+        # tag.
+        found = {}
+
+        if self.in_remove:
+            position = self.scan_remove(content, lowered, 0, tags, final)
+            if self.in_remove:
+                return tags, position
+
+        def find(marker):
+            index = found.get(marker, -2)
+            if index != -1 and index < position:
+                index = found[marker] = lowered.find(marker, position)
+            return index
+
+        while True:
+            candidates = [find(ELEMENT_START), find(COMMENT_START)]
+            if self.in_comment:
+                candidates.append(find(COMMENT_END))
+            candidates = [index for index in candidates if index != -1]
+            if not candidates:
+                break
+            start = min(candidates)
+
+            if self.in_comment and start == found[COMMENT_END]:
+                position = start + len(COMMENT_END)
+                tags.append(Tag(start, position, None, None, None))
+                self.in_comment = False
+                continue
+            if start == found[COMMENT_START]:
+                position = start + len(COMMENT_START)
+                tags.append(Tag(start, position, None, None, None))
+                self.in_comment = True
+                continue
+
+            close = lowered.find('>', start, start + MAX_TAG_LENGTH)
+            if close == -1:
+                if not final and len(content) - start < MAX_TAG_LENGTH:
+                    return tags, start
+                position = start + 1
+                continue
+            end = close + 1
+            match = element_name_re.match(lowered, start + len(ELEMENT_START))
+            name = match and match.group(0)
+
+            if name == 'include':
+                if content[close - 1] != '/' and \
+                        lowered.startswith(INCLUDE_END, end):
+                    end += len(INCLUDE_END)
+                if lowered.startswith(SIMPLE_INCLUDE_START, start) and \
+                        content.endswith(SIMPLE_INCLUDE_END, start, end) and \
+                        content.find('"', start + len(SIMPLE_INCLUDE_START),
+                            end) == end - len(SIMPLE_INCLUDE_END):
+                    # The form esi_tmpl produces needs no attribute parsing.
+                    position = end
+                    tags.append(Tag(start, end, content[
+                        start + len(SIMPLE_INCLUDE_START):
+                        end - len(SIMPLE_INCLUDE_END)], None, None))
+                    continue
+                attributes = parse_attributes(content[start:close])
+                src = attributes.get('src', None)
+                if not src:
+                    log.warning('Dropping ESI include without a src: %s' %
+                        content[start:end])
+                    src = None
+                tags.append(Tag(start, end, src, attributes.get('alt', None),
+                    attributes.get('onerror', None)))
+            elif name == 'remove':
+                end = self.scan_remove(content, lowered, start, tags, final,
+                    end)
+                if self.in_remove:
+                    return tags, end
+            elif name == 'comment':
+                tags.append(Tag(start, end, None, None, None))
+            # Any other ESI elements are left in the page, as Varnish does.
+            position = end
+
+        if final:
+            return tags, len(content)
+        settled = partial_tag_start(content, position)
+        if self.in_comment:
+            # The end of the comment may be split across pieces.
+            for length in (2, 1):
+                if content.endswith(COMMENT_END[:length], position):
+                    settled = min(settled, len(content) - length)
+                    break
+        return tags, settled
+
+    def scan_remove(self, content, lowered, start, tags, final, end=None):
+        '''
+        Adds the Tag for an ``<esi:remove>`` element starting at start, whose
+        content starts at end, or for the rest of one begun in an earlier
+        piece, and returns the index up to which content has been scanned.
+
+        Unless final is True, an element that doesn't end in content is
+        removed up to the last few characters, which could be the start of
+        its end tag, and the scan stays inside it.  Once the end of the
+        document is reached, an element that never ends only loses its start
+        tag, unless some of it has already been removed that way, in which
+        case the rest goes too.
+        '''
+        if end is None:
+            end = start
+        remove_end = lowered.find(REMOVE_END, end)
+        if remove_end != -1:
+            self.in_remove = False
+            end = remove_end + len(REMOVE_END)
+        elif final:
+            log.warning('Unterminated <esi:remove> at %d' % start)
+            if self.in_remove:
+                end = len(content)
+            self.in_remove = False
+        else:
+            self.in_remove = True
+            end = max(end, len(content) - (len(REMOVE_END) - 1))
+        if end > start:
+            tags.append(Tag(start, end, None, None, None))
+        return end
+
+
+def parse(content):
+    '''Returns the Tags in a complete document.'''
+    tags, end = Scanner().scan(content)
+    return tags
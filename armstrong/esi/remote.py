@@ -0,0 +1,181 @@
+'''
+Fetches fragments from other sites.
+
+Includes whose src is an absolute URL on one of the hosts in ESI_REMOTE_HOSTS
+are requested over HTTP rather than dispatched to the local handler.  Each host
+has a pool of keep-alive connections, at most ESI_REMOTE_MAX_CONNECTIONS of
+which are in use at a time, so a page with many includes from a host reuses a
+few connections rather than opening one per include.  Requests time out after
+ESI_REMOTE_TIMEOUT seconds and responses larger than ESI_REMOTE_MAX_SIZE bytes
+are rejected.
+
+Only a few of the page request's headers are passed on, and cookies are
+neither sent to remote hosts nor taken from their responses, since they belong
+to a different site.
+'''
+import httplib
+import socket
+import threading
+import time
+from urlparse import urlsplit, urlunsplit
+import zlib
+
+from django.conf import settings
+from django.http import HttpResponse
+
+# The page request headers, keyed as in request.META, sent on to remote hosts.
+FORWARDED_HEADERS = ('HTTP_ACCEPT_LANGUAGE', 'HTTP_USER_AGENT',
+    'HTTP_REFERER', 'HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE')
+
+# Response headers that describe the connection or the encoding of the body
+# rather than the fragment, and cookies, which are dropped.
+IGNORED_HEADERS = ('connection', 'keep-alive', 'proxy-authenticate',
+    'proxy-authorization', 'te', 'trailers', 'transfer-encoding', 'upgrade',
+    'content-length', 'content-encoding', 'set-cookie', 'set-cookie2')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class RemoteFragmentError(Exception):
+    pass
+
+
+def is_remote_url(url):
+    '''True if url is on one of the hosts in ESI_REMOTE_HOSTS.'''
+    parts = urlsplit(url)
+    return parts.scheme in ('http', 'https') and \
+        parts.netloc in getattr(settings, 'ESI_REMOTE_HOSTS', ())
+
+
+class HostPool(object):
+    '''The keep-alive connections to a single host.'''
+    def __init__(self, scheme, netloc, max_connections, timeout):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle = []
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def connect(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def acquire(self, deadline):
+        '''
+        Returns a connection and whether it has been used before, waiting
+        until deadline for one to become free if the host's are all in use.
+        '''
+        with self.condition:
+            while self.active >= self.max_connections:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RemoteFragmentError('No connection to %s became '
+                        'free in time' % self.netloc)
+                self.condition.wait(remaining)
+            self.active += 1
+            if self.idle:
+                return self.idle.pop(), True
+        return self.connect(), False
+
+    def release(self, connection, reusable):
+        with self.condition:
+            self.active -= 1
+            if reusable:
+                self.idle.append(connection)
+            self.condition.notify()
+        if not reusable:
+            connection.close()
+
+    def close(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+
+def get_pool(scheme, netloc):
+    key = (scheme, netloc)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = HostPool(scheme, netloc,
+                getattr(settings, 'ESI_REMOTE_MAX_CONNECTIONS', 4),
+                getattr(settings, 'ESI_REMOTE_TIMEOUT', 5))
+        return _pools[key]
+
+
+def close_pools():
+    '''Closes the idle connections to every host and forgets the pools.'''
+    with _pools_lock:
+        pools = _pools.values()
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def request_headers_for(request_headers):
+    '''Converts the forwarded request.META style headers to HTTP headers.'''
+    headers = {'Accept-Encoding': 'gzip, identity'}
+    for key in FORWARDED_HEADERS:
+        if key in request_headers:
+            name = '-'.join(part.capitalize() for part in key[5:].split('_'))
+            headers[name] = str(request_headers[key])
+    return headers
+
+
+def read_body(response, max_size):
+    content = response.read(max_size + 1)
+    if len(content) > max_size:
+        raise RemoteFragmentError('Response is larger than %d bytes' %
+            max_size)
+    if response.getheader('Content-Encoding', '').lower() == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        content = decompressor.decompress(content, max_size + 1)
+        if decompressor.unconsumed_tail or len(content) > max_size:
+            raise RemoteFragmentError('Response is larger than %d bytes' %
+                max_size)
+    return content
+
+
+def fetch(url, request_headers):
+    '''
+    Requests the fragment at url from its host and returns it as an
+    HttpResponse.  request_headers are the headers of the fragment request,
+    keyed as in request.META; only FORWARDED_HEADERS are sent.
+
+    Raises RemoteFragmentError if the host can't be reached, takes too long
+    or sends too much.
+    '''
+    parts = urlsplit(url)
+    pool = get_pool(parts.scheme, parts.netloc)
+    path = urlunsplit(('', '', parts.path or '/', parts.query, ''))
+    headers = request_headers_for(request_headers)
+    max_size = getattr(settings, 'ESI_REMOTE_MAX_SIZE', 1024 * 1024)
+    deadline = time.time() + pool.timeout
+
+    while True:
+        connection, reused = pool.acquire(deadline)
+        reusable = False
+        try:
+            connection.request('GET', path, headers=headers)
+            remote_response = connection.getresponse()
+            content = read_body(remote_response, max_size)
+            reusable = not remote_response.will_close
+        except (httplib.HTTPException, socket.error), e:
+            # The host may have closed an idle connection, so a failure on
+            # one is retried on a new connection.
+            if reused and not isinstance(e, socket.timeout):
+                continue
+            raise RemoteFragmentError('Fetching %s failed: %s' % (url, e))
+        finally:
+            pool.release(connection, reusable)
+        break
+
+    response = HttpResponse(content, status=remote_response.status)
+    for header, value in remote_response.getheaders():
+        if header.lower() not in IGNORED_HEADERS:
+            response[header] = value
+    return response
@@ -1,15 +1,48 @@
 from django import template
-from django.template import defaulttags
+from django.conf import settings
+from django.core.urlresolvers import get_resolver, get_script_prefix, \
+    get_urlconf
+from django.template import defaulttags, Variable
 from django.template.defaulttags import URLNode
+from django.utils import translation
+from django.utils.encoding import force_unicode
 from django.utils.text import unescape_string_literal
 
+from ..parser import esi_tmpl
+from ..utils import is_fragment_request, render_inline
+
 
 register = template.Library()
-esi_tmpl = '<esi:include src="%s" />'
+
+# The most URLs each tag with variable arguments remembers.
+MAX_REVERSE_MEMO = 1000
 
 class EsiTemplateTagError(Exception):
     pass
 
+def is_literal(value):
+    '''
+    True if a view name or argument of the tag resolves the same way in every
+    context.
+    '''
+    if not hasattr(value, 'var'):
+        # View names are plain strings in Django 1.4 and earlier.
+        return True
+    if value.filters:
+        return False
+    if isinstance(value.var, Variable):
+        return value.var.lookups is None
+    return True
+
+def reverse_key(context):
+    '''
+    Returns what reversing a URL depends on besides the tag's arguments, so
+    memoized URLs are dropped when the URLconf, script prefix, language or
+    current app change.
+    '''
+    return (get_resolver(get_urlconf()), get_script_prefix(),
+        translation.get_language(), context.current_app)
+
 class EsiNode(URLNode):
     def __init__(self, view_name, *args, **kwargs):
         # Compatibility with Django 1.5 and later
@@ -28,24 +61,97 @@ class EsiNode(URLNode):
         if '/' in str(self.view_name):
             # An actual URL has been passed instead of a view name.
             self.raw_url = unescape_string_literal(str(self.view_name))
+            self.raw_markup = esi_tmpl % self.raw_url
             self.view_name = None
         else:
             self.raw_url = None
 
+        # Tags whose view name and arguments are all literals always reverse
+        # to the same URL, so it is remembered along with its markup.  Other
+        # tags remember the URL for each combination of arguments.
+        self.is_literal = all(is_literal(value) for value in
+            [self.view_name] + list(self.args) + self.kwargs.values())
+        self._resolved = None
+        self._memo = {}
+        self._memo_key = None
+
     def render(self, context):
         try:
-            context['_esi']['used'] = True
+            esi_status = context['_esi']
         except KeyError:
             raise EsiTemplateTagError('The esi templatetag requires the esi context processor, but it isn\'t present.')
 
-        url = self.raw_url or super(EsiNode, self).render(context)
+        if self.raw_url is not None:
+            url, markup = self.raw_url, self.raw_markup
+        else:
+            url, markup = self.reverse(context)
+
+        if self.can_render_inline(context):
+            output = render_inline(context['request'], url)
+        else:
+            esi_status['used'] = True
+            # Recording the URLs lets IncludeEsiMiddleware find the tags
+            # without scanning the whole page for them.
+            esi_status.setdefault('urls', []).append(url)
+            output = markup
 
         if self.asvar:
-            url = context[self.asvar]
-            context[self.asvar] = esi_tmpl % url
+            context[self.asvar] = output
             return ''
         else:
-            return esi_tmpl % url
+            return output
+
+    def reverse(self, context):
+        '''Returns the tag's URL and its markup, memoized where possible.'''
+        key = reverse_key(context)
+        if self.is_literal:
+            resolved = self._resolved
+            if resolved is None or resolved[0] != key:
+                url = self.reverse_uncached(context)
+                resolved = self._resolved = (key, url, esi_tmpl % url)
+            return resolved[1], resolved[2]
+
+        if self._memo_key != key:
+            self._memo = {}
+            self._memo_key = key
+        view_name = self.view_name
+        if hasattr(view_name, 'resolve'):
+            view_name = view_name.resolve(context)
+        # Arguments are keyed on the text reverse puts in the URL.  Objects
+        # such as model instances hash and compare on other things, so they
+        # could otherwise share an entry with an object whose URL differs.
+        arguments = (view_name,
+            tuple(force_unicode(arg.resolve(context)) for arg in self.args),
+            tuple(sorted((name, force_unicode(value.resolve(context)))
+                for name, value in self.kwargs.items())))
+        try:
+            return self._memo[arguments]
+        except KeyError:
+            pass
+
+        url = self.reverse_uncached(context)
+        result = url, esi_tmpl % url
+        memo = self._memo
+        if len(memo) >= MAX_REVERSE_MEMO:
+            memo.clear()
+        memo[arguments] = result
+        return result
+
+    def reverse_uncached(self, context):
+        url = super(EsiNode, self).render(context)
+        if self.asvar:
+            url = context[self.asvar]
+        return url
+
+    def can_render_inline(self, context):
+        if not getattr(settings, 'ESI_INLINE', False):
+            return False
+        request = context.get('request', None)
+        if request is None or not hasattr(request, '_esi'):
+            return False
+        # Includes in fragments are left to the page's FragmentAssembler,
+        # which limits how deeply they nest.
+        return not is_fragment_request(request)
 
 @register.tag
 def esi(parser, token):
@@ -1,4 +1,8 @@
+from .cache import *
 from .context_processors import *
 from .middleware import *
 from .templatetags import *
 from .http_client import *
+from .parser import *
+from .remote import *
+from .utils import *
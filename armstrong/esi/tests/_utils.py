@@ -6,7 +6,7 @@ import fudge
 def with_fake_request(func):
     def inner(self, *args, **kwargs):
         request = fudge.Fake(HttpRequest)
-        request.has_attr(COOKIES={})
+        request.has_attr(COOKIES={}, path='/')
         result = func(self, request, *args, **kwargs)
 
         fudge.verify()
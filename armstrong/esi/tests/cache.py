@@ -0,0 +1,339 @@
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.http import HttpResponse
+from StringIO import StringIO
+import threading
+import time
+import urllib
+
+from ._utils import TestCase
+from .esi_support.views import conditional_etag
+from .middleware import patch_settings, restore_settings
+from .utils import assemble
+
+from ..cache import FragmentCache, get_backend, get_fragment_ttl, \
+    get_stale_windows, invalidate_fragment_cache, parse_cache_control, \
+    is_fresh, purge_surrogate_key, response_from_entry
+
+
+class TestOfCacheControlParsing(TestCase):
+    def test_parses_directives_with_and_without_arguments(self):
+        directives = parse_cache_control('max-age=60, Private, s-maxage="30"')
+        self.assertEqual(directives,
+            {'max-age': '60', 'private': True, 's-maxage': '30'})
+
+    def test_ttl_prefers_s_maxage(self):
+        response = HttpResponse()
+        response['Cache-Control'] = 'max-age=60, s-maxage=30'
+        self.assertEqual(get_fragment_ttl(response), 30)
+
+    def test_uncacheable_responses_have_no_ttl(self):
+        for cache_control in ('max-age=60, private', 'max-age=60, no-store',
+                'no-cache, max-age=60', 'max-age=0', 'public'):
+            response = HttpResponse()
+            response['Cache-Control'] = cache_control
+            self.assertEqual(get_fragment_ttl(response), None)
+
+    def test_stale_windows_come_from_directives_or_settings(self):
+        response = HttpResponse()
+        response['Cache-Control'] = 'max-age=60, stale-while-revalidate=30'
+        self.assertEqual(get_stale_windows(response), (30, 0))
+
+        patch_data = patch_settings({'ESI_STALE_IF_ERROR': 300})
+        self.assertEqual(get_stale_windows(response), (30, 300))
+        restore_settings(*patch_data)
+
+
+def expire_entry(url, request_headers=None):
+    fragment_cache = FragmentCache(get_backend())
+    request_headers = request_headers or {}
+    entry = fragment_cache.get(url, request_headers)
+    entry['expires'] -= 3600
+    key = fragment_cache.entry_key(url, entry['vary'], request_headers)
+    get_backend().set(key, entry, 3600)
+
+
+class CountingCache(LocMemCache):
+    '''A local memory cache that counts the calls made to it.'''
+    def __init__(self, *args, **kwargs):
+        super(CountingCache, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    def get(self, *args, **kwargs):
+        self.calls.append('get')
+        return super(CountingCache, self).get(*args, **kwargs)
+
+    def get_many(self, keys, version=None):
+        self.calls.append('get_many')
+        values = {}
+        for key in keys:
+            value = LocMemCache.get(self, key, version=version)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set(self, *args, **kwargs):
+        self.calls.append('set')
+        return super(CountingCache, self).set(*args, **kwargs)
+
+    def set_many(self, data, timeout=None, version=None):
+        self.calls.append('set_many')
+        for key, value in data.items():
+            LocMemCache.set(self, key, value, timeout, version=version)
+
+
+def wait_for_refreshes():
+    for thread in threading.enumerate():
+        if thread.name == 'armstrong.esi.refresh':
+            thread.join()
+
+
+class TestOfFragmentCache(TestCase):
+    def setUp(self):
+        super(TestOfFragmentCache, self).setUp()
+        self.patch_data = patch_settings({'ESI_CACHE_FRAGMENTS': True})
+        get_backend().clear()
+
+    def tearDown(self):
+        restore_settings(*self.patch_data)
+        super(TestOfFragmentCache, self).tearDown()
+
+    def assemble(self, url, meta=None):
+        return assemble('<esi:include src="%s" />' % url, meta=meta)
+
+    def test_cacheable_fragments_are_rendered_once(self):
+        first = self.assemble('/counter/?max-age=60')
+        second = self.assemble('/counter/?max-age=60')
+        self.assertEqual(first.content, second.content)
+
+    def test_fragments_without_max_age_are_rendered_every_time(self):
+        for url in ('/counter/', '/counter/?max-age=60&private='):
+            first = self.assemble(url)
+            second = self.assemble(url)
+            self.assertNotEqual(first.content, second.content)
+
+    def test_entries_are_keyed_on_vary_headers(self):
+        url = '/counter/?max-age=60&vary=Accept-Language'
+        english = self.assemble(url, {'HTTP_ACCEPT_LANGUAGE': 'en'})
+        spanish = self.assemble(url, {'HTTP_ACCEPT_LANGUAGE': 'es'})
+        self.assertNotEqual(english.content, spanish.content)
+
+        again = self.assemble(url, {'HTTP_ACCEPT_LANGUAGE': 'en'})
+        self.assertEqual(again.content, english.content)
+
+    def test_cookies_set_for_requests_without_any_are_not_stored(self):
+        # /counter/ sets a cookie, as a view starting a session would.
+        url = '/counter/?max-age=60&vary=Cookie'
+        first = self.assemble(url)
+        second = self.assemble(url)
+        self.assertNotEqual(first.content, second.content)
+
+        meta = {'HTTP_COOKIE': 'sessionid=abc'}
+        first = self.assemble(url, meta)
+        second = self.assemble(url, meta)
+        self.assertEqual(first.content, second.content)
+
+    def test_cached_fragments_merge_headers_and_cookies(self):
+        self.assemble('/counter/?max-age=60&vary=Accept-Language')
+        result = self.assemble('/counter/?max-age=60&vary=Accept-Language')
+        self.assertEqual(result['Vary'], 'Accept-Language')
+        self.assertEqual(result.cookies['counted'].value, 'yes')
+
+    def test_uses_the_configured_cache_backend(self):
+        patch_data = patch_settings({'ESI_CACHE_BACKEND': 'default'})
+        get_backend().clear()
+        try:
+            first = self.assemble('/counter/?max-age=60')
+            second = self.assemble('/counter/?max-age=60')
+            self.assertEqual(first.content, second.content)
+            # The fragment, its Vary header names and the generation.
+            self.assertEqual(len(get_backend()._cache), 3)
+        finally:
+            get_backend().clear()
+            restore_settings(*patch_data)
+
+    def test_cached_fragments_count_their_age_against_max_age(self):
+        url = '/counter/?max-age=60&s-maxage=120'
+        fragment_cache = FragmentCache(get_backend())
+        self.assemble(url)
+        entry = fragment_cache.get(url, {})
+        response = response_from_entry(entry, now=entry['stored'] + 50)
+        self.assertEqual(response['Cache-Control'], 'max-age=10, s-maxage=70')
+        response = response_from_entry(entry, now=entry['stored'] + 100)
+        self.assertEqual(response['Cache-Control'], 'max-age=0, s-maxage=20')
+
+    def test_invalidating_the_cache_renders_fragments_again(self):
+        url = '/counter/?max-age=60'
+        first = self.assemble(url)
+        invalidate_fragment_cache()
+        second = self.assemble(url)
+        self.assertNotEqual(first.content, second.content)
+        self.assertEqual(self.assemble(url).content, second.content)
+
+    def test_changing_the_version_renders_fragments_again(self):
+        url = '/counter/?max-age=60'
+        first = self.assemble(url)
+        patch_data = patch_settings({'ESI_CACHE_VERSION': 2})
+        try:
+            second = self.assemble(url)
+        finally:
+            restore_settings(*patch_data)
+        self.assertNotEqual(first.content, second.content)
+        self.assertEqual(self.assemble(url).content, first.content)
+
+    def test_purging_a_surrogate_key_renders_its_fragments_again(self):
+        tagged = '/counter/?max-age=60&surrogate-key=story-1+front'
+        other = '/counter/?max-age=60&surrogate-key=story-2'
+        first_tagged, first_other = self.assemble(tagged), self.assemble(other)
+        purge_surrogate_key('story-1')
+
+        self.assertNotEqual(self.assemble(tagged).content,
+            first_tagged.content)
+        self.assertEqual(self.assemble(other).content, first_other.content)
+
+    def test_fragments_purged_while_rendering_are_not_stored(self):
+        url = '/counter/?max-age=60&surrogate-key=story-1'
+        response = HttpResponse('purged')
+        response['Cache-Control'] = 'max-age=60'
+        response['Surrogate-Key'] = 'story-1'
+        started = time.time() - 1
+        purge_surrogate_key('story-1')
+        FragmentCache(get_backend()).set(url, {}, response, started)
+        self.assertNotEqual(self.assemble(url).content, 'purged')
+
+    def test_purge_command(self):
+        url = '/counter/?max-age=60&surrogate-key=story-1'
+        first = self.assemble(url)
+        call_command('esi_purge', 'story-1')
+        second = self.assemble(url)
+        self.assertNotEqual(first.content, second.content)
+
+        call_command('esi_purge', all=True)
+        self.assertNotEqual(self.assemble(url).content, second.content)
+
+    def test_warm_command_caches_included_fragments(self):
+        url = '/counter/?max-age=60'
+        nested = '/nested/?include=%s' % urllib.quote(url)
+        output = StringIO()
+        call_command('esi_warm', '/nested/?include=%s' %
+            urllib.quote(nested), '/hello/', stdout=output)
+        fragment_cache = FragmentCache(get_backend())
+        self.assertNotEqual(fragment_cache.get(url, {}), None)
+        self.assertEqual(output.getvalue(), 'Warmed 1 fragments from 2 pages: '
+            '1 stored, 0 already cached, 0 failed.\n')
+
+        cached = response_from_entry(fragment_cache.get(url, {}))
+        self.assertEqual(self.assemble(url).content, cached.content)
+
+    def test_warm_command_reports_failures(self):
+        output = StringIO()
+        errors = StringIO()
+        call_command('esi_warm', '/nested/?include=/broken/',
+            '/nested/?include=/server-error/', stdout=output, stderr=errors)
+        self.assertEqual(output.getvalue(), 'Warmed 0 fragments from 2 pages: '
+            '0 stored, 0 already cached, 2 failed.\n')
+        self.assert_('/broken/ failed: ' in errors.getvalue())
+        self.assert_('/server-error/ returned status code 500' in
+            errors.getvalue())
+
+    def test_warm_command_reads_sitemaps(self):
+        url = '/counter/?max-age=60'
+        sitemap = '/sitemap.xml?page=%s' % urllib.quote(
+            '/nested/?include=%s' % urllib.quote(url))
+        call_command('esi_warm', sitemaps=[sitemap], stdout=StringIO())
+        self.assertNotEqual(FragmentCache(get_backend()).get(url, {}), None)
+
+    def test_a_page_is_read_and_written_in_batches(self):
+        patch_data = patch_settings({'ESI_CACHE_BACKEND':
+            'armstrong.esi.tests.cache.CountingCache'})
+        try:
+            backend = get_backend()
+            urls = ['/counter/?max-age=60&n=%d' % i for i in range(5)]
+            page = ''.join('<esi:include src="%s" />' % url for url in urls)
+
+            del backend.calls[:]
+            first = assemble(page)
+            self.assertEqual(backend.calls.count('get_many'), 1)
+            self.assertEqual(backend.calls.count('set_many'), 1)
+            self.assertFalse('set' in backend.calls)
+
+            del backend.calls[:]
+            second = assemble(page)
+            self.assertEqual(backend.calls, ['get_many', 'get_many'])
+            self.assertEqual(first.content, second.content)
+        finally:
+            restore_settings(*patch_data)
+
+    def test_expired_fragments_are_rendered_again(self):
+        url = '/counter/?max-age=60'
+        first = self.assemble(url)
+        expire_entry(url)
+        second = self.assemble(url)
+        self.assertNotEqual(first.content, second.content)
+
+    def test_expired_fragments_are_revalidated_with_the_view(self):
+        url = '/conditional/'
+        first = self.assemble(url)
+        expire_entry(url)
+        second = self.assemble(url)
+        self.assertEqual(second.content, first.content)
+
+        entry = FragmentCache(get_backend()).get(url, {})
+        self.assert_(is_fresh(entry))
+
+        conditional_etag[0] = 'v2'
+        try:
+            expire_entry(url)
+            third = self.assemble(url)
+        finally:
+            conditional_etag[0] = 'v1'
+        self.assertNotEqual(third.content, first.content)
+
+    def test_revalidation_ignores_the_page_request_validators(self):
+        url = '/conditional/'
+        first = self.assemble(url)
+        patch_data = patch_settings({'ESI_DIRECT_DISPATCH': True})
+        try:
+            # Without the entry there's nothing to revalidate, so the
+            # fragment is rendered in full even though the page request
+            # carries a matching If-None-Match.
+            get_backend().clear()
+            second = self.assemble(url, {'HTTP_IF_NONE_MATCH': '"v1"'})
+        finally:
+            restore_settings(*patch_data)
+        self.assertNotEqual(second.content, '')
+        self.assertNotEqual(second.content, first.content)
+
+    def test_serves_stale_fragment_and_refreshes_it(self):
+        url = '/counter/?max-age=60&stale-while-revalidate=3600'
+        first = self.assemble(url)
+        expire_entry(url)
+
+        stale = self.assemble(url)
+        self.assertEqual(stale.content, first.content)
+        wait_for_refreshes()
+
+        refreshed = self.assemble(url)
+        self.assertNotEqual(refreshed.content, first.content)
+
+    def test_serves_cached_fragment_when_rendering_times_out(self):
+        url = '/slow/?seconds=0.5'
+        response = HttpResponse('cached')
+        response['Cache-Control'] = 'max-age=60'
+        FragmentCache(get_backend()).set(url, {}, response)
+        expire_entry(url)
+
+        patch_data = patch_settings({'ESI_FRAGMENT_TIMEOUT': 0.05})
+        result = self.assemble(url)
+        restore_settings(*patch_data)
+        self.assertEqual(result.content, 'cached')
+
+    def test_serves_stale_fragment_when_rendering_fails(self):
+        url = '/server-error/'
+        response = HttpResponse('stale')
+        response['Cache-Control'] = 'max-age=60, stale-if-error=3600'
+        FragmentCache(get_backend()).set(url, {}, response)
+        expire_entry(url)
+
+        result = self.assemble(url)
+        self.assertEqual(result.content, 'stale')
@@ -7,5 +7,15 @@ urlpatterns = patterns('armstrong.esi.tests.esi_support.views',
     url(r'^last-modified/(?P<timestamp>\d+)/$', 'last_modified', name='last_modified'),
     url(r'^vary/$', 'vary', name='vary'),
     url(r'^500chars/$', 'text', name='text'),
+    url(r'^sized/(?P<size>\d+)/(?P<number>\d+)/$', 'sized', name='sized'),
     url(r'^recursive-404/$', 'recursive_404', name='recursive_404'),
+    url(r'^counter/$', 'counter', name='counter'),
+    url(r'^conditional/$', 'conditional', name='conditional'),
+    url(r'^server-error/$', 'server_error', name='server_error'),
+    url(r'^broken/$', 'broken', name='broken'),
+    url(r'^slow/$', 'slow', name='slow'),
+    url(r'^nested/$', 'nested', name='nested'),
+    url(r'^recursive/$', 'recursive', name='recursive'),
+    url(r'^depth/(?P<levels>\d+)/$', 'depth', name='depth'),
+    url(r'^sitemap\.xml$', 'sitemap', name='sitemap'),
 )
@@ -1,7 +1,18 @@
-from django.http import HttpResponse, HttpResponseNotFound
-from django.utils.cache import cc_delim_re, patch_vary_headers
+import itertools
+import time
+
+from django.http import HttpResponse, HttpResponseNotFound, \
+    HttpResponseServerError
+from django.views.decorators.http import condition
+from django.utils.cache import cc_delim_re, patch_cache_control, \
+    patch_vary_headers
+from django.utils.html import escape
 from django.utils.http import http_date
 
+render_count = itertools.count()
+# The ETag of the conditional view, which tests change to simulate an update.
+conditional_etag = ['v1']
+
 
 def hello(request, number=None):
     if request.GET:
@@ -29,7 +40,73 @@ def vary(request):
 def text(request):
     return HttpResponse('a' * 500)
 
+def sized(request, size, number):
+    """Returns size bytes of text; number only makes the URL distinct."""
+    return HttpResponse(('%s ' % number).ljust(int(size), 'x'))
+
+def server_error(request):
+    return HttpResponseServerError('Something went wrong.')
+
+def slow(request):
+    time.sleep(float(request.GET.get('seconds', 1)))
+    return HttpResponse('slow')
+
+def broken(request):
+    raise ValueError('This view is broken.')
+
+def nested(request):
+    """Wraps an include of the URL passed as ``include`` in brackets."""
+    return HttpResponse('[<esi:include src="%s" />]' % request.GET['include'])
+
+def recursive(request):
+    return HttpResponse('<esi:include src="/recursive/" />')
+
+def depth(request, levels):
+    levels = int(levels)
+    if not levels:
+        return HttpResponse('bottom')
+    return HttpResponse('%d<esi:include src="../%d/" />' % (levels, levels - 1))
+
 def recursive_404(request):
     response = HttpResponseNotFound('<esi:include src="/recursive-404/" />')
     response._esi = {'used': True}
     return response
+
+@condition(etag_func=lambda request: conditional_etag[0])
+def conditional(request):
+    """
+    Returns a different number every time it is rendered, but answers
+    requests whose If-None-Match matches conditional_etag with a 304.
+    """
+    response = HttpResponse(str(render_count.next()))
+    patch_cache_control(response, max_age=60)
+    return response
+
+def counter(request):
+    """
+    Returns a different number every time it is rendered, with the
+    Cache-Control directives, Vary headers and Surrogate-Key header passed in
+    the query string.
+    """
+    response = HttpResponse(str(render_count.next()))
+    directives = dict((key.replace('-', '_'), value)
+        for key, value in request.GET.items()
+        if key not in ('vary', 'surrogate-key'))
+    for key, value in directives.items():
+        if value == '':
+            directives[key] = True
+    patch_cache_control(response, **directives)
+    if 'vary' in request.GET:
+        patch_vary_headers(response, cc_delim_re.split(request.GET['vary']))
+    if 'surrogate-key' in request.GET:
+        response['Surrogate-Key'] = request.GET['surrogate-key']
+    response.set_cookie('counted', 'yes')
+    return response
+
+def sitemap(request):
+    """Lists the pages given as ``page`` in a sitemap."""
+    locations = ''.join('<url><loc>http://example.com%s</loc></url>' %
+        escape(page) for page in request.GET.getlist('page'))
+    return HttpResponse('<?xml version="1.0" encoding="UTF-8"?>'
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+        '%s</urlset>' % locations, content_type='application/xml')
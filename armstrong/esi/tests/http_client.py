@@ -1,6 +1,7 @@
 import random
 
 from ._utils import TestCase
+from .middleware import patch_settings, restore_settings
 from .. import http_client
 
 
@@ -19,3 +20,60 @@ class ClientTest(TestCase):
         client = http_client.Client()
         expected = 'a = apple, b = banana'
         self.assertEqual(client.get('/hello/?b=banana&a=apple').content, expected)
+
+    def test_shared_handler_loads_middleware_once(self):
+        handler = http_client.LocalHandler()
+        http_client.Client(handler=handler).get('/hello/')
+        request_middleware = handler._request_middleware
+
+        response = http_client.Client(handler=handler).get('/hello/')
+        self.assertEqual(response.content, u'Hello World!')
+        self.assert_(handler._request_middleware is request_middleware)
+
+    def test_shared_handler_reloads_when_middleware_changes(self):
+        handler = http_client.LocalHandler()
+        http_client.Client(handler=handler).get('/hello/')
+        request_middleware = handler._request_middleware
+
+        patch_data = patch_settings({'MIDDLEWARE_CLASSES': [
+            'armstrong.esi.middleware.EsiHeaderMiddleware',
+        ]})
+        http_client.Client(handler=handler).get('/hello/')
+        restore_settings(*patch_data)
+        self.assert_(handler._request_middleware is not request_middleware)
+        self.assertEqual(len(handler._response_middleware), 1)
+
+
+class DirectHandlerTest(TestCase):
+    def test_builds_fragment_requests_from_the_page_request(self):
+        request = http_client.fragment_request('/hello/?a=apple',
+            {'session': 'abc'}, {'HTTP_ACCEPT': 'text/html',
+                'CONTENT_LENGTH': '12', 'REQUEST_METHOD': 'POST'})
+        self.assertEqual(request.path, '/hello/')
+        self.assertEqual(request.method, 'GET')
+        self.assertEqual(request.GET['a'], 'apple')
+        self.assertEqual(request.COOKIES, {'session': 'abc'})
+        self.assertEqual(request.META['HTTP_ACCEPT'], 'text/html')
+        self.assertEqual(request.META['QUERY_STRING'], 'a=apple')
+        self.assertFalse('CONTENT_LENGTH' in request.META)
+
+    def test_calls_the_view(self):
+        handler = http_client.DirectHandler()
+        request = http_client.fragment_request('/hello/?a=apple', {}, {})
+        self.assertEqual(handler(request).content, 'a = apple')
+
+    def test_runs_only_fragment_middleware(self):
+        handler = http_client.DirectHandler()
+        patch_data = patch_settings({
+            'MIDDLEWARE_CLASSES': [
+                'django.middleware.common.CommonMiddleware',
+                'armstrong.esi.middleware.EsiHeaderMiddleware',
+            ],
+            'ESI_FRAGMENT_MIDDLEWARE': [
+                'armstrong.esi.middleware.EsiHeaderMiddleware',
+            ],
+        })
+        handler(http_client.fragment_request('/hello/', {}, {}))
+        restore_settings(*patch_data)
+        self.assertEqual(len(handler._request_middleware), 0)
+        self.assertEqual(len(handler._response_middleware), 1)
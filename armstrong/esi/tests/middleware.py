@@ -11,12 +11,14 @@ import math
 import random
 import re
 import urllib
+import zlib
 
 from ._utils import TestCase
 from ._utils import with_fake_request
 from .esi_support.views import recursive_404
 
 from .. import middleware
+from ..cache import get_backend
 from ..middleware import IncludeEsiMiddleware, EsiHeaderMiddleware
 from ..utils import gunzip_response_content
 
@@ -38,15 +40,15 @@ def patch_settings(new_settings):
     added_settings = []
     for key, value in new_settings.items():
         if hasattr(settings, key):
-            patches.append(fudge.patcher.patch_object(settings, key, value))
+            patches.append((key, getattr(settings, key)))
         else:
-            setattr(settings, key, value)
             added_settings.append(key)
+        setattr(settings, key, value)
     return patches, added_settings
 
 def restore_settings(patches, added_settings):
-    for patch in patches:
-        patch.restore()
+    for key, value in patches:
+        setattr(settings, key, value)
     for setting in added_settings:
         delattr(settings, setting)
 
@@ -102,6 +104,53 @@ class TestMiddleware(TestCase):
 
         restore_settings(*patch_data)
 
+    @with_fake_request
+    def test_replaces_esi_tags_in_gzipped_response_a_segment_at_a_time(self,
+            request):
+        request.provides('get_full_path').returns('/')
+        request.provides('build_absolute_uri').returns('http://example.com/')
+        request.has_attr(_esi={'used': True})
+        request.has_attr(META={'HTTP_ACCEPT_ENCODING': 'gzip'})
+
+        response = HttpResponse()
+        esi_tag = '<esi:include src="/500chars/" />'
+        response.content = '%s%s%s' % ('y' * 250, esi_tag, 'z' * 250)
+
+        patch_data = patch_settings({
+            'MIDDLEWARE_CLASSES': MIDDLEWARES,
+            'ESI_GZIP_SEGMENTS': True,
+        })
+
+        result = full_process_response(request, response, gzip=True)
+        self.assertEqual(result['Content-Encoding'], 'gzip')
+        self.assertEqual(result['Content-Length'], str(len(result.content)))
+
+        # A single member, since some clients stop after the first.
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        content = decompressor.decompress(result.content)
+        self.assertEqual(decompressor.unused_data, '')
+        self.assertEqual(content, '%s%s%s' % ('y' * 250, 'a' * 500,
+            'z' * 250))
+
+        restore_settings(*patch_data)
+
+    @with_fake_request
+    def test_leaves_includes_in_fragment_requests(self, request):
+        request.has_attr(_esi={'used': True},
+            META={'armstrong.esi.fragment': True})
+        response = HttpResponse('<esi:include src="/hello/1/" />')
+        result = full_process_response(request, response)
+        self.assertEqual(result.content, '<esi:include src="/hello/1/" />')
+
+    @with_fake_request
+    def test_clients_cannot_ask_for_the_includes(self, request):
+        request.provides('build_absolute_uri').returns('http://example.com/')
+        request.has_attr(_esi={'used': True},
+            META={'HTTP_X_ESI_FRAGMENT': '1'})
+        response = HttpResponse('<esi:include src="/hello/1/" />')
+        result = full_process_response(request, response)
+        self.assertEqual(result.content, '1')
+
     @with_fake_request
     def test_replaces_relative_url_esi(self, request):
         rand = random.randint(100, 200)
@@ -220,6 +269,21 @@ class TestMiddleware(TestCase):
         self.check_if_max_time_is_last_modified(time_b, time_c, time_a, max_time)
         self.check_if_max_time_is_last_modified(time_c, time_a, time_b, max_time)
 
+    @with_fake_request
+    def test_merges_surrogate_keys(self, request):
+        html = '<esi:include src="/counter/?surrogate-key=story-1+front" />' \
+            '<esi:include src="/counter/?surrogate-key=front+story-2" />'
+        response = HttpResponse(html)
+        response['Surrogate-Key'] = 'section-news story-1'
+        request.has_attr(_esi={'used': True})
+        request.provides('get_full_path').returns('/page-with-esi-tags/')
+        request.provides('build_absolute_uri').returns(
+            'http://example.com/page-with-esi-tags/')
+
+        response = full_process_response(request, response)
+        self.assertEqual(response['Surrogate-Key'],
+            'section-news story-1 front story-2')
+
     @with_fake_request
     def check_merged_vary_header(self, request, main_header, fragment_header_1,
       fragment_header_2):
@@ -277,3 +341,123 @@ class TestMiddleware(TestCase):
         self.assertEqual(result.content, '')
 
         restore_settings(*patch_data)
+
+class TestOfServerTiming(TestCase):
+    @with_fake_request
+    def process(self, request, page, settings, gzip=False):
+        request.provides('get_full_path').returns('/')
+        request.provides('build_absolute_uri').returns('http://example.com/')
+        request.has_attr(_esi={'used': True})
+        request.has_attr(META={'HTTP_ACCEPT_ENCODING': 'gzip'})
+
+        patch_data = patch_settings(settings)
+        response = full_process_response(request, HttpResponse(page), gzip)
+        restore_settings(*patch_data)
+        return request, response
+
+    def test_does_nothing_unless_enabled(self):
+        request, response = self.process('<esi:include src="/hello/" />', {})
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertFalse('timings' in request._esi)
+
+    def test_times_each_stage_and_fragment(self):
+        page = '%s<esi:include src="/hello/1/" />' % ('z' * 250)
+        request, response = self.process(page, {'ESI_SERVER_TIMING': True},
+            gzip=True)
+
+        timings = request._esi['timings']
+        for name in ('gunzip', 'assemble', 'gzip'):
+            self.assert_(timings[name] >= 0)
+        self.assertEqual(len(timings['fragments']), 1)
+        fragment = timings['fragments'][0]
+        self.assertEqual((fragment['url'], fragment['status'],
+            fragment['bytes'], fragment['cache']), ('/hello/1/', 200, 1, None))
+
+        metrics = cc_delim_re.split(response['Server-Timing'])
+        self.assertEqual([metric.split(';')[0] for metric in metrics],
+            ['esi-gunzip', 'esi-assemble', 'esi-gzip', 'esi-fragment-0'])
+        self.assert_(metrics[-1].endswith(';desc="/hello/1/ 200 1B"'))
+
+    def test_records_cache_hits_and_misses(self):
+        page = '<esi:include src="/counter/?max-age=60" />'
+        settings = {'ESI_SERVER_TIMING': True, 'ESI_CACHE_FRAGMENTS': True}
+        get_backend().clear()
+        results = [self.process(page, settings)[1] for i in range(2)]
+        self.assert_(results[0]['Server-Timing'].endswith(' miss"'))
+        self.assert_(results[1]['Server-Timing'].endswith(' hit"'))
+
+
+class TestOfConditionalRequests(TestCase):
+    page = 'abc<esi:include src="/hello/1/" />' \
+        '<esi:include src="/last-modified/1000000/" />'
+
+    def setUp(self):
+        super(TestOfConditionalRequests, self).setUp()
+        self.patch_data = patch_settings({'ESI_USE_ETAGS': True})
+
+    def tearDown(self):
+        restore_settings(*self.patch_data)
+        super(TestOfConditionalRequests, self).tearDown()
+
+    @with_fake_request
+    def process(self, request, page=None, meta=None, method='GET',
+            gzip=False, last_modified=None):
+        request.provides('get_full_path').returns('/')
+        request.provides('build_absolute_uri').returns('http://example.com/')
+        request.has_attr(_esi={'used': True}, method=method)
+        request.has_attr(META=dict(meta or {}, HTTP_ACCEPT_ENCODING='gzip'))
+        response = HttpResponse(page or self.page)
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        return full_process_response(request, response, gzip)
+
+    def test_sets_a_composite_etag(self):
+        first = self.process()
+        self.assertEqual(first.content, 'abc11000000')
+        self.assertEqual(first['ETag'], self.process()['ETag'])
+        self.assertNotEqual(first['ETag'], self.process(
+            self.page.replace('abc', 'abd'))['ETag'])
+        self.assertNotEqual(first['ETag'], self.process(
+            self.page.replace('/hello/1/', '/hello/2/'))['ETag'])
+
+    def test_returns_304_when_the_etag_matches(self):
+        etag = self.process()['ETag']
+        for meta in ({'HTTP_IF_NONE_MATCH': etag},
+                {'HTTP_IF_NONE_MATCH': '"other", W/%s' % etag},
+                {'HTTP_IF_NONE_MATCH': '*'}):
+            response = self.process(meta=meta, gzip=True)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, '')
+            self.assertEqual(response['ETag'], etag)
+
+        response = self.process(meta={'HTTP_IF_NONE_MATCH': '"other"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_returns_304_when_every_part_is_unmodified(self):
+        page = '<esi:include src="/last-modified/1000000/" />'
+        for since, status in ((1000000, 304), (999999, 200)):
+            response = self.process(page,
+                meta={'HTTP_IF_MODIFIED_SINCE': http_date(since)},
+                last_modified=500000)
+            self.assertEqual(response.status_code, status)
+
+        # /hello/1/ has no Last-Modified, so the merged date can't be trusted.
+        response = self.process(
+            meta={'HTTP_IF_MODIFIED_SINCE': http_date(2000000)},
+            last_modified=500000)
+        self.assertEqual(response.status_code, 200)
+
+        # Nor can it when the page itself has none.
+        response = self.process(page,
+            meta={'HTTP_IF_MODIFIED_SINCE': http_date(2000000)})
+        self.assertEqual(response.status_code, 200)
+
+    def test_head_requests_merge_headers_without_assembling(self):
+        # GZipMiddleware leaves short pages alone.
+        page = 'z' * 250 + self.page
+        response = self.process(page, method='HEAD', gzip=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, '')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Last-Modified'], http_date(1000000))
+        self.assertEqual(response['ETag'], self.process(page)['ETag'])
@@ -0,0 +1,100 @@
+from ._utils import TestCase
+
+from ..parser import Scanner, Tag, parse
+
+
+def strip(content):
+    '''Removes every tag from content, as the assembler does for markup.'''
+    return strip_tags(content, parse(content))
+
+
+def strip_tags(content, tags):
+    segments = []
+    last_end = 0
+    for tag in tags:
+        segments.append(content[last_end:tag.start])
+        segments.append(tag.src and '[%s]' % tag.src or '')
+        last_end = tag.end
+    segments.append(content[last_end:])
+    return ''.join(segments)
+
+
+class TestOfParse(TestCase):
+    def test_finds_include_attributes(self):
+        tags = parse('<esi:include src="/a/" alt=\'/b/\' onerror="continue"/>')
+        self.assertEqual(tags, [Tag(0, 53, '/a/', '/b/', 'continue')])
+        self.assert_(tags[0].continue_on_error)
+
+    def test_is_case_insensitive(self):
+        self.assertEqual(strip('a<ESI:Include SRC="/b/" />c'), 'a[/b/]c')
+
+    def test_consumes_closing_include_tags(self):
+        self.assertEqual(strip('a<esi:include src="/b/"></esi:include>c'),
+            'a[/b/]c')
+
+    def test_removes_remove_blocks_and_comments(self):
+        content = ('a<esi:remove><a href="/b/">b</a></esi:remove>c'
+            '<esi:comment text="d" />e')
+        self.assertEqual(strip(content), 'ace')
+
+    def test_processes_markup_inside_esi_comments(self):
+        content = 'a<!--esi <esi:include src="/b/" /> -->c<!-- d -->'
+        self.assertEqual(strip(content), 'a [/b/] c<!-- d -->')
+
+    def test_leaves_other_markup_alone(self):
+        for content in ('a<esi:vars>$(b)</esi:vars>', 'a --> b',
+                '<esi:include src="/a/"', '<esi:remove>a'):
+            self.assertEqual(strip(content), content.replace(
+                '<esi:remove>', ''))
+
+    def test_drops_includes_without_a_src(self):
+        self.assertEqual(parse('<esi:include alt="/a/" />'),
+            [Tag(0, 25, None, '/a/', None)])
+
+
+class TestOfScanner(TestCase):
+    content = ('a<esi:include src="/b/" />c<esi:remove>d</esi:remove>'
+        '<!--esi e<esi:include src="/f/" /> -->g')
+
+    def scan_in_pieces(self, pieces):
+        scanner = Scanner()
+        result = []
+        remainder = ''
+        for piece in pieces:
+            content = remainder + piece
+            tags, settled = scanner.scan(content, final=False)
+            result.append((content[:settled], tags))
+            remainder = content[settled:]
+        tags, settled = scanner.scan(remainder)
+        result.append((remainder, tags))
+        return result
+
+    def test_matches_a_single_scan_wherever_the_content_is_split(self):
+        expected = [tag.src for tag in parse(self.content) if tag.src]
+        for i in range(len(self.content) + 1):
+            result = self.scan_in_pieces([self.content[:i], self.content[i:]])
+            self.assertEqual(''.join(text for text, tags in result),
+                self.content)
+            # A remove block split across pieces is removed a piece at a time.
+            self.assertEqual([tag.src for text, tags in result
+                for tag in tags if tag.src], expected)
+            self.assertEqual(''.join(strip_tags(text, tags)
+                for text, tags in result), strip(self.content))
+
+    def test_removes_unterminated_remove_blocks_as_they_stream(self):
+        scanner = Scanner()
+        content = 'a<esi:remove>' + 'b' * 100
+        tags, settled = scanner.scan(content, final=False)
+        # Only what could be the start of </esi:remove> is held back.
+        self.assertEqual(len(content) - settled, len('</esi:remove>') - 1)
+        self.assertEqual(tags, [Tag(1, settled, None, None, None)])
+
+        content = content[settled:] + 'b' * 100 + '</esi:rem'
+        tags, settled = scanner.scan(content, final=False)
+        self.assertEqual(len(content) - settled, len('</esi:remove>') - 1)
+        self.assertEqual(tags, [Tag(0, settled, None, None, None)])
+
+        content = content[settled:] + 'ove>c'
+        tags, settled = scanner.scan(content, final=False)
+        self.assertEqual(tags, [Tag(0, len(content) - 1, None, None, None)])
+        self.assertEqual(settled, len(content))
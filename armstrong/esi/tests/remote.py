@@ -0,0 +1,133 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import threading
+import time
+
+from ._utils import TestCase
+from .middleware import patch_settings, restore_settings
+from .utils import assemble
+
+from .. import remote
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path.startswith('/slow/'):
+            time.sleep(0.5)
+        if self.path.startswith('/big/'):
+            body = 'x' * 2000
+        elif self.path.startswith('/nested/'):
+            body = '<esi:include src="/hello/1/" />'
+        else:
+            body = 'remote %s' % self.path
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Vary', 'Accept-Language')
+        self.send_header('Set-Cookie', 'remote=yes')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.connections = set()
+        self.requests = []
+
+    def handle_error(self, request, client_address):
+        # Clients that give up on a request, as the timeout tests do, leave
+        # broken pipes behind; they aren't worth a traceback.
+        pass
+
+
+class TestOfRemoteIncludes(TestCase):
+    def setUp(self):
+        super(TestOfRemoteIncludes, self).setUp()
+        self.server = StandInServer()
+        thread = threading.Thread(target=self.server.serve_forever,
+            kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        self.host = '127.0.0.1:%d' % self.server.server_address[1]
+        self.patch_data = patch_settings({
+            'ESI_REMOTE_HOSTS': [self.host],
+            'ESI_REMOTE_MAX_CONNECTIONS': 1,
+            'ESI_REMOTE_TIMEOUT': 0.2,
+            'ESI_REMOTE_MAX_SIZE': 1000,
+        })
+
+    def tearDown(self):
+        remote.close_pools()
+        restore_settings(*self.patch_data)
+        self.server.shutdown()
+        self.server.server_close()
+        super(TestOfRemoteIncludes, self).tearDown()
+
+    def assemble(self, page, max_workers=1):
+        return assemble(page, {'ESI_MAX_WORKERS': max_workers},
+            {'HTTP_ACCEPT_LANGUAGE': 'es', 'HTTP_COOKIE': 'session=secret'})
+
+    def test_includes_fragments_from_remote_hosts(self):
+        result = self.assemble('<esi:include src="http://%s/weather/" />'
+            '|<esi:include src="/hello/1/" />' % self.host)
+        self.assertEqual(result.content, 'remote /weather/|1')
+        self.assertEqual(result['Vary'], 'Accept-Language')
+        self.assertFalse('remote' in result.cookies)
+
+        path, headers = self.server.requests[0]
+        self.assertEqual(headers['accept-language'], 'es')
+        self.assertFalse('cookie' in headers)
+
+    def test_root_relative_includes_in_remote_fragments_stay_remote(self):
+        result = self.assemble('<esi:include src="http://%s/nested/" />' %
+            self.host)
+        self.assertEqual(result.content, 'remote /hello/1/')
+        self.assertEqual([path for path, headers in self.server.requests],
+            ['/nested/', '/hello/1/'])
+
+    def test_only_listed_hosts_are_remote(self):
+        self.assertEqual(remote.is_remote_url('http://%s/a/' % self.host),
+            True)
+        self.assertEqual(remote.is_remote_url('http://example.com/a/'), False)
+        self.assertEqual(remote.is_remote_url('/a/'), False)
+
+    def test_hosts_not_listed_are_dispatched_locally(self):
+        result = self.assemble(
+            '<esi:include src="http://example.com/hello/1/" />')
+        self.assertEqual(result.content, '1')
+        self.assertEqual(self.server.requests, [])
+
+    def test_reuses_connections(self):
+        page = ''.join('<esi:include src="http://%s/comments/%d/" />' %
+            (self.host, i) for i in range(4))
+        result = self.assemble(page, max_workers=4)
+        self.assertEqual(result.content, ''.join('remote /comments/%d/' % i
+            for i in range(4)))
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_rejects_large_responses(self):
+        self.assertRaises(remote.RemoteFragmentError, remote.fetch,
+            'http://%s/big/' % self.host, {})
+        result = self.assemble('<esi:include src="http://%s/big/" '
+            'onerror="continue" />' % self.host)
+        self.assertEqual(result.content, '')
+
+    def test_times_out(self):
+        self.assertRaises(remote.RemoteFragmentError, remote.fetch,
+            'http://%s/slow/' % self.host, {})
+
+    def test_unreachable_hosts_fail(self):
+        remote.close_pools()
+        self.server.server_close()
+        self.assertRaises(remote.RemoteFragmentError, remote.fetch,
+            'http://%s/weather/' % self.host, {})
@@ -1,13 +1,18 @@
 from django import template, VERSION as django_version
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import clear_url_caches, get_urlconf, \
+    reverse, set_urlconf
+from django.http import HttpRequest, HttpResponse
 from django.template import Token, Parser, TOKEN_BLOCK
 from django.template import FilterExpression
+from django.utils import translation
 import fudge
 import random
 
 from .._utils import TestCase
+from ..middleware import patch_settings, restore_settings
 
 from ... import context_processors
+from ...middleware import IncludeEsiMiddleware
 from ...templatetags.esi import EsiNode
 from ...templatetags.esi import esi
 
@@ -19,6 +24,16 @@ def create_context():
     return context
 
 
+def create_inline_context(meta=None):
+    request = HttpRequest()
+    request.path = '/'
+    request.META = {'SERVER_NAME': 'example.com', 'SERVER_PORT': '80'}
+    request.META.update(meta or {})
+    context = template.Context({'request': request})
+    context.update(context_processors.esi(request))
+    return context
+
+
 def create_token(content):
     return Token(TOKEN_BLOCK, content)
 
@@ -67,6 +82,92 @@ class TestOfEsiNode(TestCase):
 
         self.assertTrue(context['_esi']['used'])
 
+    def test_records_rendered_urls_on_context(self):
+        context = create_context()
+        for url in ('./one/', './two/'):
+            node = esi(Parser([]), create_token('esi "%s"' % url))
+            node.render(context)
+
+        self.assertEqual(context['_esi']['urls'], ['./one/', './two/'])
+
+
+class TestOfReverseMemo(TestCase):
+    def count_reverses(self, node):
+        calls = []
+        reverse_uncached = node.reverse_uncached
+
+        def counting(context):
+            calls.append(True)
+            return reverse_uncached(context)
+        node.reverse_uncached = counting
+        return calls
+
+    def test_reverses_literal_tags_once(self):
+        view_name = create_view_name('hello_number')
+        node = esi(Parser([]), create_token('esi %s number=5' % view_name))
+        self.assert_(node.is_literal)
+        calls = self.count_reverses(node)
+
+        results = [node.render(create_context()) for i in range(3)]
+        self.assertEqual(results, ['<esi:include src="%s" />' %
+            reverse('hello_number', kwargs={'number': 5})] * 3)
+        self.assertEqual(len(calls), 1)
+
+    def test_reverses_again_when_the_urlconf_changes(self):
+        view_name = create_view_name('hello_world')
+        node = esi(Parser([]), create_token('esi %s' % view_name))
+        calls = self.count_reverses(node)
+
+        node.render(create_context())
+        clear_url_caches()
+        node.render(create_context())
+        self.assertEqual(len(calls), 2)
+
+    def test_memoizes_each_combination_of_variable_arguments(self):
+        view_name = create_view_name('hello_number')
+        node = esi(Parser([]), create_token(
+            'esi %s number=number' % view_name))
+        self.assertFalse(node.is_literal)
+        calls = self.count_reverses(node)
+
+        results = []
+        for number in (1, 2, 1, 2):
+            context = create_context()
+            context['number'] = number
+            results.append(node.render(context))
+        self.assertEqual(results, ['<esi:include src="%s" />' %
+            reverse('hello_number', kwargs={'number': number})
+            for number in (1, 2, 1, 2)])
+        self.assertEqual(len(calls), 2)
+
+    def test_memoizes_arguments_on_their_text(self):
+        class Story(object):
+            # Equal and hashed alike, as model instances with the same pk
+            # are, but with different text.
+            def __init__(self, number):
+                self.number = number
+
+            def __eq__(self, other):
+                return True
+
+            def __hash__(self):
+                return 0
+
+            def __unicode__(self):
+                return unicode(self.number)
+
+        view_name = create_view_name('hello_number')
+        node = esi(Parser([]), create_token(
+            'esi %s number=story' % view_name))
+        results = []
+        for number in (1, 2):
+            context = create_context()
+            context['story'] = Story(number)
+            results.append(node.render(context))
+        self.assertEqual(results, ['<esi:include src="%s" />' %
+            reverse('hello_number', kwargs={'number': number})
+            for number in (1, 2)])
+
 
 class TestOfEsiHandler(TestCase):
     def test_extracts_view_out_of_templatetag_call(self):
@@ -108,3 +209,61 @@ class TestOfEsiHandler(TestCase):
         result = t.render(context).strip()
         expected_url = reverse('hello_world')
         self.assertEquals(result, '<esi:include src="%s" />' % expected_url)
+
+
+class TestOfInlineRendering(TestCase):
+    def setUp(self):
+        super(TestOfInlineRendering, self).setUp()
+        self.patch_data = patch_settings({'ESI_INLINE': True})
+
+    def tearDown(self):
+        restore_settings(*self.patch_data)
+        super(TestOfInlineRendering, self).tearDown()
+
+    def render(self, context, url):
+        node = esi(Parser([]), create_token('esi "%s"' % url))
+        return node.render(context)
+
+    def test_renders_the_fragment_in_place_of_the_tag(self):
+        context = create_inline_context()
+        self.assertEqual(self.render(context, '/hello/5/'), '5')
+        self.assertFalse(context['_esi']['used'])
+
+    def test_middleware_merges_inlined_cookies_without_a_second_pass(self):
+        context = create_inline_context()
+        content = self.render(context, '/cookies/7/') + \
+            '<esi:include src="/hello/" />'
+        response = IncludeEsiMiddleware().process_response(
+            context['request'], HttpResponse(content))
+        self.assertEqual(response.content, content)
+        self.assertEqual(response.cookies['number'].value, '7')
+
+    def test_keeps_the_page_urlconf(self):
+        urlconf = 'armstrong.esi.tests.esi_support.urls'
+        set_urlconf(urlconf)
+        try:
+            self.render(create_inline_context(), '/hello/5/')
+            self.assertEqual(get_urlconf(), urlconf)
+        finally:
+            set_urlconf(None)
+
+    def test_keeps_the_page_language(self):
+        patch_data = patch_settings({'MIDDLEWARE_CLASSES':
+            ['django.middleware.locale.LocaleMiddleware']})
+        translation.activate('es')
+        try:
+            self.render(create_inline_context(), '/hello/5/')
+            self.assertEqual(translation.get_language(), 'es')
+        finally:
+            translation.deactivate()
+            restore_settings(*patch_data)
+
+    def test_emits_tags_without_a_request_in_the_context(self):
+        context = create_context()
+        self.assertEqual(self.render(context, '/hello/5/'),
+            '<esi:include src="/hello/5/" />')
+
+    def test_emits_tags_inside_fragments(self):
+        context = create_inline_context({'armstrong.esi.fragment': True})
+        self.assertEqual(self.render(context, '/hello/5/'),
+            '<esi:include src="/hello/5/" />')
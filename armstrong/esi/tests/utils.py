@@ -0,0 +1,431 @@
+from django.http import HttpRequest, HttpResponse
+from django.utils.http import http_date
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django 1.4 and earlier
+    StreamingHttpResponse = None
+import random
+import time
+import urllib
+import zlib
+
+from ._utils import TestCase
+from ._utils import with_fake_request
+from .middleware import patch_settings, restore_settings
+
+from ..middleware import IncludeEsiMiddleware
+from ..parser import Tag, parse, partial_tag_start
+from ..utils import FragmentTimeout, deflate_segment, find_esi_tags, \
+    gunzip_chunks, gzip_chunks, gzip_segments, is_streaming_response, \
+    map_concurrently, merge_fragments, render_fragment_within, \
+    replace_esi_tags, stream_esi_tags
+
+
+def prepare_fake_request(request, path='/page-with-esi-tags/'):
+    request.has_attr(_esi={'used': True}, path=path)
+    request.provides('build_absolute_uri').returns(
+        'http://example.com%s' % path)
+    return request
+
+
+def assemble(page, settings=None, meta=None, status=200):
+    '''
+    Returns page as an HttpResponse with status, assembled by replace_esi_tags
+    for a request with the extra meta while settings are patched in.
+    '''
+    request = HttpRequest()
+    request.path = '/page-with-esi-tags/'
+    request.META = {'SERVER_NAME': 'example.com', 'SERVER_PORT': '80'}
+    request.META.update(meta or {})
+    request._esi = {'used': True}
+    patch_data = patch_settings(settings or {})
+    try:
+        response = HttpResponse(page, status=status)
+        replace_esi_tags(request, response)
+    finally:
+        restore_settings(*patch_data)
+    return response
+
+
+class TestOfReplaceEsiTags(TestCase):
+    @with_fake_request
+    def test_leaves_content_without_tags_untouched(self, request):
+        prepare_fake_request(request)
+        content = 'no tags here %d' % random.randint(100, 200)
+        response = HttpResponse(content)
+        replace_esi_tags(request, response)
+        self.assertEqual(response.content, content)
+
+    @with_fake_request
+    def test_splices_every_fragment_in_document_order(self, request):
+        prepare_fake_request(request)
+        numbers = [random.randint(100, 200) for i in range(50)]
+        static = ['<p>%d</p>' % i for i in range(len(numbers) + 1)]
+        tags = ['<esi:include src="/hello/%d/" />' % n for n in numbers]
+
+        page = static[0] + ''.join(t + s for t, s in zip(tags, static[1:]))
+        expected = static[0] + ''.join(
+            str(n) + s for n, s in zip(numbers, static[1:]))
+
+        response = HttpResponse(page)
+        replace_esi_tags(request, response)
+        self.assertEqual(response.content, expected)
+
+    def check_assembled_page(self, max_workers, direct=False):
+        urls = ['/cookies/1/', '/vary/?headers=Cookie', '/hello/5/',
+            '/last-modified/1000/', '/cookies/2/', '/vary/?headers=Accept']
+        page = '|'.join('<esi:include src="%s" />' % url for url in urls)
+        return assemble(page, {'ESI_MAX_WORKERS': max_workers,
+            'ESI_DIRECT_DISPATCH': direct})
+
+    def test_concurrent_rendering_matches_sequential_rendering(self):
+        sequential = self.check_assembled_page(1)
+        concurrent = self.check_assembled_page(4)
+
+        self.assertEqual(concurrent.content, sequential.content)
+        self.assertEqual(concurrent['Vary'], sequential['Vary'])
+        self.assertEqual(concurrent['Last-Modified'],
+            sequential['Last-Modified'])
+        self.assertEqual(concurrent.cookies.output(),
+            sequential.cookies.output())
+        self.assertEqual(concurrent.cookies['number'].value, '2')
+
+    def test_direct_dispatch_matches_the_full_handler(self):
+        handler = self.check_assembled_page(1)
+        direct = self.check_assembled_page(1, direct=True)
+
+        self.assertEqual(direct.content, handler.content)
+        self.assertEqual(direct['Vary'], handler['Vary'])
+        self.assertEqual(direct['Last-Modified'], handler['Last-Modified'])
+        self.assertEqual(direct.cookies.output(), handler.cookies.output())
+
+
+class TestOfFindEsiTags(TestCase):
+    page = 'a<esi:include src="/one/" />b<esi:include src="/two/" />c'
+    expected = [Tag(1, 28, '/one/', None, None),
+        Tag(29, 56, '/two/', None, None)]
+
+    def test_finds_recorded_urls(self):
+        self.assertEqual(find_esi_tags(self.page, ['/one/', '/two/']),
+            self.expected)
+
+    def test_scans_the_page_without_recorded_urls(self):
+        self.assertEqual(find_esi_tags(self.page), self.expected)
+
+    def test_scans_the_page_when_recorded_urls_are_incomplete(self):
+        self.assertEqual(find_esi_tags(self.page, ['/one/']), self.expected)
+
+    def test_scans_the_page_when_a_recorded_url_is_missing(self):
+        self.assertEqual(find_esi_tags(self.page, ['/one/', '/three/']),
+            self.expected)
+
+    def test_scans_the_page_for_markup_in_other_cases(self):
+        page = ('a<esi:include src="/a/" /><Esi:remove>old</Esi:remove>'
+            '<!--ESI x -->')
+        self.assertEqual(find_esi_tags(page, ['/a/']), parse(page))
+        self.assertEqual(find_esi_tags('<ESI:include src="/a/" />',
+            ['/a/']), parse('<ESI:include src="/a/" />'))
+
+    def test_finds_recorded_urls_among_other_text(self):
+        page = 'design <esi:include src="/esi/" /> resize'
+        self.assertEqual(find_esi_tags(page, ['/esi/']),
+            [Tag(7, 34, '/esi/', None, None)])
+
+    @with_fake_request
+    def test_replaces_tags_at_recorded_urls(self, request):
+        prepare_fake_request(request)
+        request._esi['urls'] = ['/hello/1/', '/hello/2/']
+        response = HttpResponse('<esi:include src="/hello/1/" />-'
+            '<esi:include src="/hello/2/" />')
+        replace_esi_tags(request, response)
+        self.assertEqual(response.content, '1-2')
+
+
+class TestOfIncludeAttributes(TestCase):
+    def test_falls_back_to_alt(self):
+        for src in ('/server-error/', '/broken/'):
+            result = assemble(
+                'a<esi:include src="%s" alt="/hello/1/" />b' % src)
+            self.assertEqual(result.content, 'a1b')
+
+    def test_continues_past_failures_when_asked_to(self):
+        result = assemble('a<esi:include src="/broken/" '
+            'alt="/server-error/" onerror="continue" />b')
+        self.assertEqual(result.content, 'ab')
+
+    def test_raises_failures_otherwise(self):
+        self.assertRaises(ValueError, assemble,
+            '<esi:include src="/broken/" />')
+
+    def test_removes_esi_markup(self):
+        result = assemble('a<esi:remove>b</esi:remove><!--esi c -->'
+            '<esi:comment text="d" />')
+        self.assertEqual(result.content, 'a c ')
+
+    def test_removes_esi_markup_from_error_pages(self):
+        result = assemble('a<esi:remove>b</esi:remove>'
+            '<esi:include src="/hello/" />c', status=404)
+        self.assertEqual(result.content, 'ac')
+
+
+class TestOfTimeouts(TestCase):
+    def assemble(self, page, settings):
+        started = time.time()
+        response = assemble(page, settings)
+        return response, time.time() - started
+
+    def test_leaves_slow_fragments_empty(self):
+        result, duration = self.assemble(
+            'a<esi:include src="/slow/?seconds=0.5" />b',
+            {'ESI_FRAGMENT_TIMEOUT': 0.05})
+        self.assertEqual(result.content, 'ab')
+        self.assert_(duration < 0.4)
+
+    def test_falls_back_to_alt(self):
+        result, duration = self.assemble(
+            '<esi:include src="/slow/?seconds=0.5" alt="/hello/1/" />',
+            {'ESI_FRAGMENT_TIMEOUT': 0.05})
+        self.assertEqual(result.content, '1')
+
+    def test_limits_the_whole_page(self):
+        page = ''.join('<esi:include src="/slow/?seconds=0.3&n=%d" />' % i
+            for i in range(5))
+        result, duration = self.assemble(page,
+            {'ESI_ASSEMBLY_TIMEOUT': 0.1, 'ESI_FRAGMENT_TIMEOUT': 10})
+        self.assertEqual(result.content, '')
+        self.assert_(duration < 0.3)
+
+    def test_does_not_render_again_while_a_late_render_runs(self):
+        url = '/slow/?seconds=0.3&n=%d' % random.randint(1000, 2000)
+        self.assertRaises(FragmentTimeout, render_fragment_within,
+            {}, {}, url, 0.05)
+        started = time.time()
+        self.assertRaises(FragmentTimeout, render_fragment_within,
+            {}, {}, url, 1)
+        self.assert_(time.time() - started < 0.1)
+
+        time.sleep(0.4)
+        response = render_fragment_within({}, {}, url, 1)
+        self.assertEqual(response.content, 'slow')
+
+    def test_renders_fast_fragments_in_full(self):
+        result, duration = self.assemble('<esi:include src="/hello/1/" />',
+            {'ESI_FRAGMENT_TIMEOUT': 5, 'ESI_ASSEMBLY_TIMEOUT': 5})
+        self.assertEqual(result.content, '1')
+
+
+class TestOfMapConcurrently(TestCase):
+    def test_returns_results_in_order(self):
+        items = range(20)
+        result = map_concurrently(lambda i: i * 2, items, max_workers=4)
+        self.assertEqual(result, [i * 2 for i in items])
+
+    def test_reraises_the_first_error(self):
+        def func(i):
+            if i in (3, 7):
+                raise ValueError(i)
+            return i
+
+        try:
+            map_concurrently(func, range(10), max_workers=4)
+        except ValueError, e:
+            self.assertEqual(e.args, (3, ))
+        else:
+            self.fail('ValueError was not raised')
+
+
+class TestOfNestedIncludes(TestCase):
+    def test_replaces_includes_inside_fragments(self):
+        result = assemble(
+            '<esi:include src="/nested/?include=/hello/5/" />')
+        self.assertEqual(result.content, '[5]')
+
+    def test_resolves_relative_urls_against_the_fragment(self):
+        result = assemble('<esi:include src="/depth/2/" />')
+        self.assertEqual(result.content, '21bottom')
+
+    def test_stops_at_the_maximum_depth(self):
+        result = assemble('<esi:include src="/depth/5/" />',
+            {'ESI_MAX_DEPTH': 3})
+        self.assertEqual(result.content, '543')
+
+    def test_drops_cyclic_includes(self):
+        result = assemble('a<esi:include src="/recursive/" />b')
+        self.assertEqual(result.content, 'ab')
+
+    def test_renders_fragments_at_several_levels_once(self):
+        inner = '/nested/?include=/counter/'
+        outer = '/nested/?include=%s' % urllib.quote(inner)
+        result = assemble(
+            '<esi:include src="%s" /><esi:include src="%s" />' % (inner, outer))
+        number = result.content.strip('[]').split(']')[0]
+        self.assertEqual(result.content,
+            '[%s][[%s]]' % (number, number))
+
+
+class TestOfRepeatedIncludes(TestCase):
+    def assemble(self, urls):
+        return assemble(
+            '|'.join('<esi:include src="%s" />' % url for url in urls))
+
+    def test_renders_each_url_once(self):
+        result = self.assemble(['/counter/', '/hello/1/', '/counter/'])
+        first, middle, last = result.content.split('|')
+        self.assertEqual(middle, '1')
+        self.assertEqual(first, last)
+
+    def test_merges_cookies_in_order_of_first_appearance(self):
+        result = self.assemble(['/cookies/1/', '/cookies/2/', '/cookies/1/'])
+        self.assertEqual(result.cookies['number'].value, '2')
+
+
+class TestOfCacheHeaderMerging(TestCase):
+    def merge(self, page_headers, *fragment_headers):
+        response = HttpResponse()
+        for header, value in page_headers.items():
+            response[header] = value
+        fragments = []
+        for headers in fragment_headers:
+            fragment = HttpResponse()
+            for header, value in headers.items():
+                fragment[header] = value
+            fragments.append(fragment)
+        merge_fragments(response, fragments)
+        return response
+
+    def test_lowers_max_age_to_the_shortest_fragment(self):
+        response = self.merge({'Cache-Control': 'public, max-age=300'},
+            {'Cache-Control': 'max-age=60'}, {'Cache-Control': 'max-age=10'},
+            {})
+        self.assertEqual(response['Cache-Control'], 'max-age=10, public')
+
+    def test_restrictive_directives_win(self):
+        response = self.merge({'Cache-Control': 'public, max-age=300'},
+            {'Cache-Control': 'private, max-age=600'},
+            {'Cache-Control': 'no-store'})
+        self.assertEqual(response['Cache-Control'],
+            'max-age=300, no-store, private')
+
+    def test_fragment_max_age_limits_the_shared_lifetime(self):
+        response = self.merge({'Cache-Control': 'max-age=300, s-maxage=600'},
+            {'Cache-Control': 'max-age=120'},
+            {'Cache-Control': 'max-age=600, s-maxage=30'})
+        self.assertEqual(response['Cache-Control'],
+            'max-age=120, s-maxage=30')
+
+    def test_adds_s_maxage_when_shared_lifetime_is_shorter(self):
+        response = self.merge({'Cache-Control': 'max-age=300'},
+            {'Cache-Control': 'max-age=300, s-maxage=30'})
+        self.assertEqual(response['Cache-Control'],
+            'max-age=300, s-maxage=30')
+
+    def test_does_not_add_lifetimes_the_page_lacks(self):
+        response = self.merge({}, {'Cache-Control': 'max-age=60'})
+        self.assertFalse(response.has_header('Cache-Control'))
+
+    def test_uses_the_earliest_expires(self):
+        response = self.merge({'Expires': http_date(2000000)},
+            {'Expires': http_date(1000000)}, {'Expires': 'invalid'})
+        self.assertEqual(response['Expires'], http_date(0))
+
+        response = self.merge({'Expires': http_date(2000000)},
+            {'Expires': http_date(1000000)})
+        self.assertEqual(response['Expires'], http_date(1000000))
+
+        response = self.merge({}, {'Expires': http_date(1000000)})
+        self.assertFalse(response.has_header('Expires'))
+
+    def test_merges_surrogate_control(self):
+        response = self.merge(
+            {'Surrogate-Control': 'content="ESI/1.0", max-age=300+60'},
+            {'Surrogate-Control': 'max-age=30+600'},
+            {'Surrogate-Control': 'max-age=120'})
+        self.assertEqual(response['Surrogate-Control'],
+            'content="ESI/1.0", max-age=30')
+
+        response = self.merge({}, {'Surrogate-Control': 'no-store'})
+        self.assertEqual(response['Surrogate-Control'], 'no-store')
+
+
+class TestOfStreamingResponses(TestCase):
+    page = 'abc<esi:include src="/hello/7/" />def<esi:include src="/hello/" />'
+    expected = 'abc7defHello World!'
+
+    @with_fake_request
+    def stream(self, request, chunks, gzip=False):
+        prepare_fake_request(request)
+        if StreamingHttpResponse is not None:
+            response = StreamingHttpResponse(chunks)
+        else:
+            response = HttpResponse(iter(chunks))
+        if gzip:
+            response['Content-Encoding'] = 'gzip'
+        patch_data = patch_settings({'ESI_STREAM_ITERATORS': True})
+        try:
+            self.assert_(is_streaming_response(response))
+            stream_esi_tags(request, response)
+        finally:
+            restore_settings(*patch_data)
+        return list(response)
+
+    def test_replaces_tags_split_across_chunks(self):
+        for i in range(1, len(self.page)):
+            chunks = [self.page[:i], self.page[i:]]
+            self.assertEqual(''.join(self.stream(chunks)), self.expected)
+
+    def test_removes_markup_split_across_chunks(self):
+        page = 'a<esi:remove>b</esi:remove><!--esi c -->' + self.page
+        expected = 'a c ' + self.expected
+        for i in range(1, len(page)):
+            chunks = [page[:i], page[i:]]
+            self.assertEqual(''.join(self.stream(chunks)), expected)
+
+    def test_yields_content_as_it_goes(self):
+        chunks = [self.page[i:i + 5] for i in range(0, len(self.page), 5)]
+        result = self.stream(chunks)
+        self.assert_(len(result) > 4)
+        self.assert_(max(len(chunk) for chunk in result) <
+            len(self.expected))
+
+    def test_partial_tags_are_held_back_only_when_they_could_be_tags(self):
+        self.assertEqual(partial_tag_start('abc<esi:incl'), 3)
+        self.assertEqual(partial_tag_start('abc<es'), 3)
+        self.assertEqual(partial_tag_start('abc<p'), 5)
+        self.assertEqual(partial_tag_start('abc<esi:include />'), 18)
+
+    def test_streams_gzipped_content(self):
+        compressed = list(gzip_chunks([self.page[:10], self.page[10:]]))
+        result = ''.join(gunzip_chunks(self.stream(compressed, gzip=True)))
+        self.assertEqual(result, self.expected)
+
+    @with_fake_request
+    def test_middleware_streams_streaming_responses(self, request):
+        if StreamingHttpResponse is None:
+            return
+        prepare_fake_request(request)
+        response = StreamingHttpResponse(iter([self.page[:20],
+            self.page[20:]]))
+        response = IncludeEsiMiddleware().process_response(request, response)
+        self.assertEqual(''.join(response), self.expected)
+
+
+class TestOfGzipSegments(TestCase):
+    def decompress(self, stream):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = decompressor.decompress(stream) + decompressor.flush()
+        self.assertEqual(decompressor.unused_data, '')
+        return data
+
+    def test_segments_are_compressed_into_one_member(self):
+        segments = ['abc' * 100, '', 'def', 'abc' * 100]
+        self.assertEqual(self.decompress(gzip_segments(segments)),
+            ''.join(segments))
+
+    def test_compresses_empty_content(self):
+        self.assertEqual(self.decompress(gzip_segments([])), '')
+        self.assertEqual(self.decompress(gzip_segments([''])), '')
+
+    def test_reuses_blocks_of_recent_segments(self):
+        data = 'segment %d' % random.randint(1000, 2000)
+        self.assert_(deflate_segment(data) is deflate_segment(data))
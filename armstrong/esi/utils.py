@@ -1,19 +1,34 @@
+from collections import deque
 from cStringIO import StringIO
-from email.utils import parsedate
+from email.utils import mktime_tz, parsedate, parsedate_tz
 import gzip
+import hashlib
 import logging
-import re
+import Queue
+import struct
+import sys
+import threading
 import time
 from urlparse import urljoin
+import zlib
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.core.urlresolvers import get_urlconf, set_urlconf
+from django.db import close_connection
+from django.http import HttpResponse, SimpleCookie
 from django.middleware.gzip import GZipMiddleware
 from django.utils.cache import cc_delim_re
 from django.utils.datastructures import MultiValueDict
+from django.utils.encoding import smart_str
 from django.utils.http import http_date
+from django.utils import translation
 
-from . import http_client
+from . import http_client, remote
+from .parser import COMMENT_START, ELEMENT_START, Scanner, Tag, esi_tmpl, \
+    parse
+from .cache import get_fragment_cache, is_fresh, can_serve_stale, \
+    can_serve_on_error, conditional_headers, format_cache_control, \
+    parse_cache_control, response_from_entry, revalidated_response
 
 try:
     from logging import NullHandler
@@ -26,7 +41,23 @@ except ImportError:
 
 log = logging.getLogger('armstrong.esi')
 log.addHandler(NullHandler())
-esi_tag_re = re.compile(r'<esi:include src="(?P<url>[^"]+?)"\s*/>', re.I)
+GZIP_LEVEL = 6
+# The number of recently compressed segments kept by deflate_segment, and the
+# largest segment worth keeping.
+GZIP_SEGMENT_CACHE_SIZE = 512
+GZIP_SEGMENT_MAX_SIZE = 256 * 1024
+# A gzip member header with no file name or modification time, and an empty
+# final deflate block to end the blocks of the segments with.
+GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+DEFLATE_FINAL_BLOCK = '\x03\x00'
+
+_deflated_segments = {}
+_deflated_segments_order = deque()
+_deflated_segments_lock = threading.Lock()
+
+# The URLs of fragments still rendering after timing out.
+_late_renders = set()
+_late_renders_lock = threading.Lock()
 
 def reduce_vary_headers(response, additional):
     '''Merges the Vary header values so all headers are included.'''
@@ -55,9 +86,141 @@ def reduce_last_modified_headers(response, additional):
     latest = max(dates)
     response['Last-Modified'] = http_date(latest)
 
+def reduce_surrogate_key_headers(response, additional):
+    '''
+    Merges the space-separated Surrogate-Key header values so the page is
+    tagged with the keys of all of its fragments.
+    '''
+    original = response.get('Surrogate-Key', None)
+    if original is not None:
+        additional.insert(0, original)
+    seen_keys = set()
+    final_keys = []
+    for keys in additional:
+        for key in keys.split():
+            if key not in seen_keys:
+                seen_keys.add(key)
+                final_keys.append(key)
+    response['Surrogate-Key'] = ' '.join(final_keys)
+
+# Cache-Control directives that make a response less cacheable.  If any
+# fragment sends one, so does the page.
+RESTRICTIVE_CACHE_DIRECTIVES = ('private', 'no-cache', 'no-store',
+    'must-revalidate', 'proxy-revalidate')
+# Cache-Control directives whose lowest value across the page and its
+# fragments applies to the page.
+LIFETIME_CACHE_DIRECTIVES = ('stale-while-revalidate', 'stale-if-error')
+
+def parse_seconds(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+def lowest(*values):
+    values = [value for value in values if value is not None]
+    return min(values) if values else None
+
+def reduce_cache_control_headers(response, additional):
+    '''
+    Rewrites Cache-Control so the page is cached no longer, and no more
+    widely, than any of its fragments allows.
+
+    Restrictive directives such as private and no-store are added if any
+    fragment sends them.  The lifetimes the page declares are lowered to the
+    shortest of its fragments', with each fragment's max-age counting as its
+    s-maxage if it has none, but a lifetime the page doesn't declare isn't
+    added.
+    '''
+    directives = parse_cache_control(response.get('Cache-Control', None))
+    max_age = parse_seconds(directives.get('max-age', None))
+    shared_max_age = lowest(parse_seconds(directives.get('s-maxage', None)),
+        max_age)
+    for value in additional:
+        fragment = parse_cache_control(value)
+        for name in RESTRICTIVE_CACHE_DIRECTIVES:
+            if name in fragment:
+                directives[name] = True
+        for name in LIFETIME_CACHE_DIRECTIVES:
+            if name in directives:
+                limit = lowest(parse_seconds(directives[name]),
+                    parse_seconds(fragment.get(name, None)))
+                if limit is not None:
+                    directives[name] = str(limit)
+        fragment_max_age = parse_seconds(fragment.get('max-age', None))
+        fragment_shared_max_age = lowest(
+            parse_seconds(fragment.get('s-maxage', None)), fragment_max_age)
+        if max_age is not None:
+            max_age = lowest(max_age, fragment_max_age)
+        if shared_max_age is not None:
+            shared_max_age = lowest(shared_max_age, fragment_shared_max_age)
+
+    if 'private' in directives:
+        directives.pop('public', None)
+    if max_age is not None:
+        directives['max-age'] = str(max_age)
+    if shared_max_age is not None and ('s-maxage' in directives or
+            shared_max_age != max_age):
+        directives['s-maxage'] = str(shared_max_age)
+    if directives:
+        response['Cache-Control'] = format_cache_control(directives)
+
+def reduce_expires_headers(response, additional):
+    '''
+    Sets Expires to the earliest of all of the header values, if the page
+    sends one.
+    '''
+    if 'Expires' not in response:
+        return
+    dates = [parsedate_tz(date_str) for date_str in
+        additional + [response['Expires']]]
+    # An invalid date means the response has already expired.
+    dates = [mktime_tz(date) if date else 0 for date in dates]
+    response['Expires'] = http_date(min(dates))
+
+def parse_surrogate_max_age(value):
+    '''
+    Parses a Surrogate-Control max-age, which may give a period during which
+    the response can be served stale after a plus sign, into a tuple.
+    '''
+    if value is None or value is True:
+        return None
+    max_age, plus, stale = value.partition('+')
+    max_age = parse_seconds(max_age)
+    if max_age is None:
+        return None
+    return max_age, parse_seconds(stale) or 0
+
+def reduce_surrogate_control_headers(response, additional):
+    '''
+    Rewrites Surrogate-Control so the page is kept by surrogates no longer
+    than any of its fragments allows: no-store is added if any fragment sends
+    it, and the page's max-age is lowered to the shortest of the fragments'.
+    '''
+    directives = parse_cache_control(response.get('Surrogate-Control', None))
+    max_age = parse_surrogate_max_age(directives.get('max-age', None))
+    for value in additional:
+        fragment = parse_cache_control(value)
+        if 'no-store' in fragment:
+            directives['no-store'] = True
+        fragment_max_age = parse_surrogate_max_age(fragment.get('max-age',
+            None))
+        if max_age is not None and fragment_max_age is not None:
+            max_age = (min(max_age[0], fragment_max_age[0]),
+                min(max_age[1], fragment_max_age[1]))
+    if max_age is not None:
+        directives['max-age'] = '%d+%d' % max_age if max_age[1] else \
+            str(max_age[0])
+    if directives:
+        response['Surrogate-Control'] = format_cache_control(directives)
+
 HEADERS_TO_MERGE = {
     'Vary': reduce_vary_headers,
     'Last-Modified': reduce_last_modified_headers,
+    'Surrogate-Key': reduce_surrogate_key_headers,
+    'Cache-Control': reduce_cache_control_headers,
+    'Expires': reduce_expires_headers,
+    'Surrogate-Control': reduce_surrogate_control_headers,
 }
 
 def merge_fragment_headers(response, fragment_headers):
@@ -84,8 +247,10 @@ def merge_fragment_cookies(response, fragment_cookies):
     '''
     if not fragment_cookies:
         return
-    cookies = fragment_cookies[0]
-    cookies_to_reduce = fragment_cookies[1:]
+    # Fragment responses can be reused within a request, so their cookies are
+    # copied rather than modified.
+    cookies = SimpleCookie()
+    cookies_to_reduce = list(fragment_cookies)
     cookies_to_reduce.append(response.cookies)
     for cookie_obj in cookies_to_reduce:
         for key, morsel in cookie_obj.items():
@@ -94,6 +259,19 @@ def merge_fragment_cookies(response, fragment_cookies):
             dict.__setitem__(cookies, key, morsel)
     response.cookies = cookies
 
+def merge_fragments(response, fragments):
+    '''Merges the headers and cookies of fragments, in order, into response.'''
+    fragment_headers = MultiValueDict()
+    fragment_cookies = []
+    for fragment in fragments:
+        for header in HEADERS_TO_MERGE:
+            if header in fragment:
+                fragment_headers.appendlist(header, fragment[header])
+        if fragment.cookies:
+            fragment_cookies.append(fragment.cookies)
+    merge_fragment_headers(response, fragment_headers)
+    merge_fragment_cookies(response, fragment_cookies)
+
 def gunzip_response_content(response):
     '''
     If the response has already been compressed, gunzip it so we can modify
@@ -107,56 +285,910 @@ def gunzip_response_content(response):
 def gzip_response_content(request, response):
     GZipMiddleware().process_response(request, response)
 
-def build_full_fragment_url(request, url):
-    if url.startswith('/'):
-        return url
-    else:
-        return urljoin(request.path, url)
+def deflate_segment(data):
+    '''
+    Returns data compressed as raw deflate blocks ending in a full flush, which
+    leaves the compressor byte aligned with no history.  Blocks like these can
+    be concatenated and wrapped by gzip_segments into a single gzip member, so
+    a page can be compressed a segment at a time.
 
-# TODO: Test this independently of the middleware
-# TODO: Reduce the lines of codes and varying functionality of this code so its
-#       tests can be reduced in complexity.
-def replace_esi_tags(request, response):
-    process_errors = getattr(settings, 'ESI_PROCESS_ERRORS', False)
-    fragment_headers = MultiValueDict()
-    fragment_cookies = []
-    request_data = {
-        'cookies': request.COOKIES,
-        'HTTP_REFERER': request.build_absolute_uri(),
-        'HTTP_X_ESI_FRAGMENT': True,
-    }
-
-    replacement_offset = 0
-    for match in esi_tag_re.finditer(response.content):
-        url = build_full_fragment_url(request, match.group('url'))
-
-        if response.status_code == 200 or process_errors:
-            client = http_client.Client(**request_data)
-            fragment = client.get(url)
+    The blocks of recently compressed segments are kept, keyed on a digest of
+    their content, so static text and fragments that show up on page after
+    page are only compressed once.  The oldest blocks are dropped first.
+    '''
+    if not data:
+        return ''
+    cacheable = len(data) <= GZIP_SEGMENT_MAX_SIZE
+    if cacheable:
+        key = hashlib.md5(data).digest()
+        with _deflated_segments_lock:
+            block = _deflated_segments.get(key)
+        if block is not None:
+            return block
+
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    block = compressor.compress(data) + compressor.flush(zlib.Z_FULL_FLUSH)
+
+    if cacheable:
+        with _deflated_segments_lock:
+            if key not in _deflated_segments:
+                _deflated_segments_order.append(key)
+            _deflated_segments[key] = block
+            while len(_deflated_segments_order) > GZIP_SEGMENT_CACHE_SIZE:
+                del _deflated_segments[_deflated_segments_order.popleft()]
+    return block
+
+def gzip_segments(segments):
+    '''
+    Returns the concatenation of segments compressed as one gzip member made
+    of the deflate_segment blocks of each, so clients that only read the first
+    member of a gzip stream get the whole page.
+    '''
+    blocks = [GZIP_HEADER]
+    crc = 0
+    size = 0
+    for segment in segments:
+        blocks.append(deflate_segment(segment))
+        crc = zlib.crc32(segment, crc)
+        size += len(segment)
+    blocks.append(DEFLATE_FINAL_BLOCK)
+    blocks.append(struct.pack('<II', crc & 0xffffffff, size & 0xffffffff))
+    return ''.join(blocks)
+
+def gunzip_chunks(chunks):
+    '''
+    Decompresses a gzipped stream one chunk at a time.  Streams made of
+    several gzip members are decompressed in full.
+    '''
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            # Anything after the end of a member starts the next one.
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = decompressor.flush()
+    if data:
+        yield data
+
+def gzip_chunks(chunks):
+    '''
+    Compresses a stream one chunk at a time, flushing after each chunk so the
+    client can start on it straight away.
+    '''
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+def find_esi_tags(content, recorded_urls=None):
+    '''
+    Returns the Tags for the ESI markup in content, in order.
+
+    recorded_urls are the srcs the {% esi %} template tag emitted while the
+    page was rendered, in order.  When the page holds exactly those includes
+    they are found in a single pass over the page; otherwise, such as when
+    markup was written into the page some other way, the content is scanned.
+    '''
+    if recorded_urls:
+        tags = find_recorded_tags(content, recorded_urls)
+        if tags is not None:
+            return tags
+    return parse(content)
+
+def find_recorded_tags(content, recorded_urls):
+    '''
+    Returns the Tags for recorded_urls if they are the only ESI markup in
+    content, or None.  Markup is matched regardless of case, as the parser
+    does, by searching a lowercased copy of the page once for the "esi" that
+    every start of markup contains.
+    '''
+    lowered = content.lower()
+    element_offset = ELEMENT_START.index('esi')
+    comment_offset = COMMENT_START.index('esi')
+    tags = []
+    position = 0
+    while True:
+        index = lowered.find('esi', position)
+        if index == -1:
+            break
+        position = index + 3
+        start = index - element_offset
+        if start < 0 or not lowered.startswith(ELEMENT_START, start):
+            if index >= comment_offset and lowered.startswith(COMMENT_START,
+                    index - comment_offset):
+                return None
+            continue
+        if len(tags) == len(recorded_urls):
+            return None
+        url = recorded_urls[len(tags)]
+        tag = esi_tmpl % url
+        if not content.startswith(tag, start):
+            return None
+        position = start + len(tag)
+        tags.append(Tag(start, position, url, None, None))
+    if len(tags) != len(recorded_urls):
+        return None
+    return tags
+
+def build_full_fragment_url(request, url, base_url=None):
+    '''
+    Resolves the src of an include.  Relative URLs are resolved against
+    base_url, the URL of the fragment the include appeared in, or the path of
+    the page request for includes on the page itself.  Root-relative URLs in
+    a fragment fetched from a remote host stay on that host.
+    '''
+    return urljoin(base_url or request.path, url)
+
+def worker_target(func, language):
+    '''
+    Wraps func to run in a thread of its own with the given language active,
+    closing the thread's database connections afterwards just as the end of a
+    request would.
+    '''
+    def target():
+        translation.activate(language)
+        try:
+            func()
+        finally:
+            translation.deactivate()
+            close_connection()
+    return target
+
+def map_concurrently(func, items, max_workers=1):
+    '''
+    Calls func on every item using at most max_workers threads and returns the
+    results in the same order as items.
+
+    If any call raises, the exception for the earliest item is re-raised once
+    every worker has finished.
+    '''
+    items = list(items)
+    num_workers = min(max_workers or 1, len(items))
+    if num_workers <= 1:
+        return [func(item) for item in items]
+
+    jobs = Queue.Queue()
+    for job in enumerate(items):
+        jobs.put(job)
+    results = [None] * len(items)
+    errors = {}
+
+    def work():
+        while True:
+            try:
+                index, item = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception:
+                errors[index] = sys.exc_info()
+
+    target = worker_target(work, translation.get_language())
+    workers = [threading.Thread(target=target) for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        exc_type, exc_value, exc_tb = errors[min(errors)]
+        raise exc_type, exc_value, exc_tb
+    return results
+
+class FragmentTimeout(Exception):
+    pass
+
+def is_fragment_request(request):
+    '''
+    True if request was made for a fragment by a FragmentAssembler or
+    esi_warm, rather than by a client.
+    '''
+    return bool(getattr(request, 'META', {}).get(http_client.FRAGMENT_META))
+
+def render_fragment(request_data, request_headers, url):
+    '''
+    Renders the fragment at url.  With ESI_DIRECT_DISPATCH the view is called
+    with a request built from request_headers, skipping the WSGI layer and
+    all but the ESI_FRAGMENT_MIDDLEWARE; otherwise the fragment is requested
+    through the full handler with request_data.  URLs on the hosts in
+    ESI_REMOTE_HOSTS are fetched over HTTP instead.
+    '''
+    if remote.is_remote_url(url):
+        return remote.fetch(url, request_headers)
+    if getattr(settings, 'ESI_DIRECT_DISPATCH', False):
+        request = http_client.fragment_request(url,
+            request_data.get('cookies'), request_headers)
+        return http_client.direct_handler(request)
+    client = http_client.Client(handler=http_client.local_handler,
+        **request_data)
+    return client.get(url)
+
+def render_fragment_within(request_data, request_headers, url, timeout,
+        on_late=None):
+    '''
+    Renders the fragment in a thread of its own, raising FragmentTimeout if it
+    takes longer than timeout seconds.  A None timeout renders it in the
+    calling thread with no limit.
+
+    The thread can't be stopped, so a fragment that times out goes on
+    rendering in the background.  If it then succeeds, on_late is called with
+    the response so the work isn't wasted.  Until it finishes, FragmentTimeout
+    is raised straight away for the same URL rather than starting another
+    render, so a view that hangs holds one thread and database connection
+    rather than one for every page that includes it.
+    '''
+    if timeout is None:
+        return render_fragment(request_data, request_headers, url)
+    if timeout <= 0:
+        raise FragmentTimeout(url)
+    with _late_renders_lock:
+        if url in _late_renders:
+            raise FragmentTimeout(url)
+
+    lock = threading.Lock()
+    state = {'timed_out': False}
+
+    def render():
+        response = None
+        try:
+            response = render_fragment(request_data, request_headers, url)
+        except Exception:
+            with lock:
+                state['error'] = sys.exc_info()
+                late = state['timed_out']
         else:
-            fragment = HttpResponse()
+            with lock:
+                state['response'] = response
+                late = state['timed_out']
+        if not late:
+            return
+        try:
+            if response is not None and on_late is not None and \
+                    response.status_code == 200:
+                on_late(response)
+        finally:
+            with _late_renders_lock:
+                _late_renders.discard(url)
 
+    thread = threading.Thread(name='armstrong.esi.fragment',
+        target=worker_target(render, translation.get_language()))
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    with lock:
+        if 'response' not in state and 'error' not in state:
+            state['timed_out'] = True
+            with _late_renders_lock:
+                _late_renders.add(url)
+            raise FragmentTimeout(url)
+    if 'error' in state:
+        exc_type, exc_value, exc_tb = state['error']
+        raise exc_type, exc_value, exc_tb
+    return state['response']
+
+# Request headers that make a request conditional, keyed as in request.META.
+CONDITIONAL_HEADERS = ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE',
+    'HTTP_IF_MATCH', 'HTTP_IF_UNMODIFIED_SINCE', 'HTTP_IF_RANGE')
+
+def fragment_request_headers(request, request_data):
+    '''
+    Returns the headers, keyed as in request.META, that a fragment request made
+    with request_data sees.  These are what fragment cache entries vary on.
+    '''
+    headers = dict(getattr(request, 'META', {}))
+    # The page request's validators are for the page, not its fragments.
+    for key in CONDITIONAL_HEADERS:
+        headers.pop(key, None)
+    for key, value in request_data.items():
+        if key.startswith('HTTP_'):
+            headers[key] = str(value)
+    return headers
+
+def render_revalidating(request_data, request_headers, url, entry,
+        timeout=None, on_late=None):
+    '''
+    Renders the fragment as render_fragment_within does, but if entry holds a
+    copy with an ETag or Last-Modified header, the view is asked whether it
+    is still current.  If the view answers 304 the stored copy is used,
+    updated with the 304's headers.  Returns the response and whether it is
+    the revalidated copy.
+    '''
+    validators = entry and conditional_headers(entry)
+    if validators:
+        request_data = dict(request_data, **validators)
+        request_headers = dict(request_headers, **validators)
+    fragment = render_fragment_within(request_data, request_headers, url,
+        timeout, on_late=on_late)
+    if validators and fragment.status_code == 304:
+        return revalidated_response(entry, fragment), True
+    return fragment, False
+
+def refresh_in_background(fragment_cache, entry, request_data,
+        request_headers, url):
+    '''
+    Renders the fragment again in a background thread and stores the result,
+    unless a refresh of the same entry is already running.
+    '''
+    if not fragment_cache.acquire_refresh_lock(url, entry, request_headers):
+        return None
+
+    def refresh():
+        try:
+            started = time.time()
+            fragment, revalidated = render_revalidating(request_data,
+                request_headers, url, entry)
+            fragment_cache.set(url, request_headers, fragment, started)
+        except Exception:
+            log.exception('Refreshing ESI fragment %s failed' % url)
+        finally:
+            fragment_cache.release_refresh_lock(url, entry, request_headers)
+
+    thread = threading.Thread(name='armstrong.esi.refresh',
+        target=worker_target(refresh, translation.get_language()))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def fetch_fragment(fragment_cache, request_data, request_headers, url,
+        timeout=None):
+    '''
+    Returns the response for the fragment at url, from fragment_cache if it
+    holds a fresh copy and by rendering the view otherwise, along with how the
+    cache was used: 'hit', 'stale', 'miss', or None if fragment_cache is None
+    because fragments aren't cached.  A rendered fragment is stored at the
+    cache's next flush.
+
+    An expired copy is still used while it is within its stale-while-revalidate
+    window, with one refresh started in the background, or within its
+    stale-if-error window if rendering the view fails.  An expired copy with
+    an ETag or Last-Modified header is revalidated with the view, and used
+    again with the cache status 'revalidated' if it is current.  If rendering
+    the view takes longer than timeout seconds any cached copy is used, and
+    FragmentTimeout is raised if there isn't one.
+    '''
+    if fragment_cache is None:
+        return render_fragment_within(request_data, request_headers, url,
+            timeout), None
+
+    entry = cached = fragment_cache.get(url, request_headers)
+    if entry is not None:
+        now = time.time()
+        if is_fresh(entry, now):
+            return response_from_entry(entry), 'hit'
+        if can_serve_stale(entry, now):
+            refresh_in_background(fragment_cache, entry, request_data,
+                request_headers, url)
+            return response_from_entry(entry), 'stale'
+        if not can_serve_on_error(entry, now):
+            entry = None
+
+    started = time.time()
+    store = lambda fragment: fragment_cache.set(url, request_headers,
+        fragment, started)
+    try:
+        fragment, revalidated = render_revalidating(request_data,
+            request_headers, url, cached, timeout, on_late=store)
+    except FragmentTimeout:
+        if cached is None:
+            raise
+        log.warning('ESI fragment %s timed out, serving a cached copy' % url)
+        return response_from_entry(cached), 'stale'
+    except Exception:
+        if entry is None:
+            raise
+        log.exception('ESI fragment %s failed, serving a stale copy' % url)
+        return response_from_entry(entry), 'stale'
+
+    if fragment.status_code != 200 and entry is not None:
+        log.warning('ESI fragment %s returned status code %s, serving a '
+            'stale copy' % (url, fragment.status_code))
+        return response_from_entry(entry), 'stale'
+
+    fragment_cache.set_later(url, request_headers, fragment, started)
+    return fragment, 'revalidated' if revalidated else 'miss'
+
+def record_timing(request, name, started):
+    '''
+    Records the seconds since started as the named timing of the request when
+    ESI_SERVER_TIMING is set.
+    '''
+    if getattr(settings, 'ESI_SERVER_TIMING', False):
+        request._esi.setdefault('timings', {})[name] = time.time() - started
+
+def server_timing_header(timings):
+    '''
+    Formats the timings recorded for a request as a Server-Timing header
+    value, with durations in milliseconds.
+    '''
+    metrics = []
+    for name in ('gunzip', 'assemble', 'gzip'):
+        if name in timings:
+            metrics.append('esi-%s;dur=%.2f' % (name, timings[name] * 1000))
+    for index, fragment in enumerate(timings.get('fragments', [])):
+        description = '%s %s %dB' % (fragment['url'], fragment['status'],
+            fragment['bytes'])
+        if fragment['cache']:
+            description += ' %s' % fragment['cache']
+        description = description.replace('\\', '\\\\').replace('"', '\\"')
+        metrics.append('esi-fragment-%d;dur=%.2f;desc="%s"' % (index,
+            fragment['duration'] * 1000, description))
+    return ', '.join(metrics)
+
+class FragmentAssembler(object):
+    '''
+    Replaces the ESI includes on a page, and the includes nested inside its
+    fragments, for a single request.
+
+    Nested includes are followed up to ESI_MAX_DEPTH levels deep and an
+    include of a fragment by itself, directly or further down, is dropped.
+    Assembled fragments are memoized by URL for the life of the assembler, so
+    a fragment that is included at several nesting levels is only fetched and
+    assembled once.
+    '''
+    def __init__(self, request):
+        self.request = request
+        self.process_errors = getattr(settings, 'ESI_PROCESS_ERRORS', False)
+        self.max_workers = getattr(settings, 'ESI_MAX_WORKERS', 1)
+        self.max_depth = getattr(settings, 'ESI_MAX_DEPTH', 5)
+        self.fragment_timeout = getattr(settings, 'ESI_FRAGMENT_TIMEOUT', None)
+        assembly_timeout = getattr(settings, 'ESI_ASSEMBLY_TIMEOUT', None)
+        self.deadline = None
+        if assembly_timeout is not None:
+            self.deadline = time.time() + assembly_timeout
+        self.request_data = {
+            'cookies': request.COOKIES,
+            'HTTP_REFERER': request.build_absolute_uri(),
+        }
+        self.request_headers = fragment_request_headers(request,
+            self.request_data)
+        # With ESI_SERVER_TIMING, a dictionary of the url, duration, status,
+        # bytes and cache use of each fragment fetched, in the order they
+        # finish.
+        self.timings = None
+        if getattr(settings, 'ESI_SERVER_TIMING', False):
+            self.timings = []
+        self.fragment_cache = get_fragment_cache()
+        # With ESI_USE_ETAGS, the validator of each fragment fetched, keyed
+        # by URL, and whether any of them lacked a Last-Modified header.
+        self.validators = None
+        self.missing_last_modified = False
+        if getattr(settings, 'ESI_USE_ETAGS', False):
+            self.validators = {}
+        # Only touched through single dict operations, which are atomic, so
+        # worker threads can share it without a lock.
+        self.memo = {}
+
+    def time_left(self):
+        '''
+        Returns the number of seconds the next fragment may take to render,
+        or None if there's no limit.
+        '''
+        timeouts = []
+        if self.fragment_timeout is not None:
+            timeouts.append(self.fragment_timeout)
+        if self.deadline is not None:
+            timeouts.append(self.deadline - time.time())
+        return min(timeouts) if timeouts else None
+
+    def record_timing(self, url, started, status, size, cache_status):
+        if self.timings is not None:
+            self.timings.append({
+                'url': url,
+                'duration': time.time() - started,
+                'status': status,
+                'bytes': size,
+                'cache': cache_status,
+            })
+
+    def assemble(self, url, ancestors=()):
+        '''
+        Returns the fragment response for url with its own includes replaced,
+        and whether every nested include could be followed.  ancestors are
+        the URLs of the fragments the include is nested in.
+        '''
+        if url in self.memo:
+            return self.memo[url], True
+        if url in ancestors:
+            log.error('ESI include cycle: %s' %
+                ' -> '.join(ancestors + (url, )))
+            return HttpResponse(), False
+        if len(ancestors) >= self.max_depth:
+            log.error('ESI fragment %s is nested more than %d levels deep' %
+                (url, self.max_depth))
+            return HttpResponse(), False
+
+        started = time.time()
+        try:
+            fragment, cache_status = fetch_fragment(self.fragment_cache,
+                self.request_data, self.request_headers, url, self.time_left())
+        except FragmentTimeout:
+            self.record_timing(url, started, 'timeout', 0, None)
+            raise
+        if self.validators is not None:
+            self.validators[url] = fragment.get('ETag', None) or \
+                hashlib.md5(fragment.content).hexdigest()
+            if 'Last-Modified' not in fragment:
+                self.missing_last_modified = True
+        complete = True
+        if fragment.status_code == 200:
+            complete = self.replace_tags(fragment, url, ancestors + (url, ))
+        self.record_timing(url, started, fragment.status_code,
+            len(fragment.content), cache_status)
+        # A fragment with an include cut short by the depth limit or a cycle
+        # might come out differently elsewhere in the page.
+        if complete:
+            self.memo[url] = fragment
+        return fragment, complete
+
+    def include(self, key, ancestors=()):
+        '''
+        Returns the fragment for an include, as returned by assemble.  key is
+        the (url, alt, continue_on_error) tuple from include_key.
+
+        If the fragment can't be rendered, returns an error or times out the
+        alt URL is tried instead.  If that fails too the include is left
+        empty, and with continue_on_error the failure isn't treated as an
+        error.  Timeouts always leave the include empty.
+        '''
+        url, alt, continue_on_error = key
+        candidates = [url] if alt is None else [url, alt]
+        for index, candidate in enumerate(candidates):
+            is_last = index == len(candidates) - 1
+            try:
+                fragment, complete = self.assemble(candidate, ancestors)
+            except FragmentTimeout:
+                if not is_last:
+                    log.warning('ESI fragment %s timed out, trying %s' %
+                        (candidate, alt))
+                    continue
+                log.warning('ESI fragment %s timed out' % candidate)
+                return HttpResponse(), True
+            except Exception:
+                if not is_last:
+                    log.warning('ESI fragment %s failed, trying %s' %
+                        (candidate, alt), exc_info=True)
+                    continue
+                if not continue_on_error:
+                    raise
+                log.info('ESI fragment %s failed, continuing' % candidate,
+                    exc_info=True)
+                return HttpResponse(), True
+            if fragment.status_code == 200:
+                break
+            if not is_last:
+                log.warning('ESI fragment %s returned status code %s, trying '
+                    '%s' % (candidate, fragment.status_code, alt))
+        self.discard_error_content(candidate, fragment,
+            quiet=continue_on_error)
+        return fragment, complete
+
+    def include_key(self, tag, base_url=None):
+        '''
+        Returns the (url, alt, continue_on_error) tuple identifying an include
+        tag's fragment, or None for markup that is only removed.
+        '''
+        if tag.src is None:
+            return None
+        alt = tag.alt and build_full_fragment_url(self.request, tag.alt,
+            base_url)
+        return (build_full_fragment_url(self.request, tag.src, base_url),
+            alt or None, tag.continue_on_error)
+
+    def prefetch(self, keys):
+        '''
+        Reads the cached copies of the fragments for the include keys from
+        the fragment cache in one batch.
+        '''
+        if self.fragment_cache is None:
+            return
+        urls = []
+        for url, alt, continue_on_error in keys:
+            urls.append(url)
+            if alt is not None:
+                urls.append(alt)
+        self.fragment_cache.prefetch(urls, self.request_headers)
+
+    def flush(self):
+        '''Writes the fragments rendered since the last flush to the cache.'''
+        if self.fragment_cache is not None:
+            self.fragment_cache.flush()
+
+    def discard_error_content(self, url, fragment, quiet=False):
         if fragment.status_code != 200:
             # Remove the error content so it isn't added to the page.
             fragment.content = ''
+            if quiet:
+                log.info('ESI fragment %s returned status code %s, '
+                    'continuing' % (url, fragment.status_code))
+                return
             extra = {'data': {
                 'fragment': fragment.__dict__,
-                'request': request.__dict__,
+                'request': self.request.__dict__,
             }}
             log.error('ESI fragment %s returned status code %s' %
                 (url, fragment.status_code), extra=extra)
 
-        start = match.start() + replacement_offset
-        end = match.end() + replacement_offset
-        response.content = '%s%s%s' % (response.content[:start],
-            fragment.content, response.content[end:])
-        replacement_offset += len(fragment.content) - len(match.group(0))
+    def replace_tags(self, response, base_url=None, ancestors=(),
+            max_workers=1, compress=False, recorded_urls=None, render=True,
+            before_splice=None):
+        '''
+        Replaces the includes in response with their fragments and merges the
+        fragments' headers and cookies into it, and removes the rest of its
+        ESI markup.  Returns whether every nested include could be followed.
 
-        for header in HEADERS_TO_MERGE:
-            if header in fragment:
-                fragment_headers.appendlist(header, fragment[header])
-        if fragment.cookies:
-            fragment_cookies.append(fragment.cookies)
+        If compress is True the content is written as a gzip member compressed
+        a segment at a time; see gzip_segments.  recorded_urls are passed on
+        to find_esi_tags.  If render is False the includes are removed
+        instead.  before_splice is called with the response once the
+        fragments' headers and cookies have been merged, and if it returns
+        False the content is left as it is.
+        '''
+        content = response.content
+        tags = find_esi_tags(content, recorded_urls)
+        if not tags:
+            if before_splice is not None and not before_splice(response):
+                return True
+            if compress:
+                response.content = gzip_segments([content])
+            return True
+        if render:
+            keys = [self.include_key(tag, base_url) for tag in tags]
+        else:
+            keys = [None] * len(tags)
 
-    merge_fragment_headers(response, fragment_headers)
-    merge_fragment_cookies(response, fragment_cookies)
+        # Each distinct include is fetched once, however often it appears.
+        distinct_keys = []
+        seen = set([None])
+        for key in keys:
+            if key not in seen:
+                seen.add(key)
+                distinct_keys.append(key)
+
+        # Fragments are independent of each other, so they can be rendered
+        # concurrently.  Everything that depends on their order -- the
+        # splicing and the header and cookie merging -- happens afterwards in
+        # document order, so the result is the same as rendering them one at
+        # a time.
+        self.prefetch(distinct_keys)
+        include = lambda key: self.include(key, ancestors)
+        try:
+            results = map_concurrently(include, distinct_keys, max_workers)
+        finally:
+            self.flush()
+
+        # Headers and cookies are merged once per distinct fragment, in the
+        # order the fragments first appear.
+        merge_fragments(response, [fragment for fragment, complete in results])
+        complete = all(complete for fragment, complete in results)
+        if before_splice is not None and not before_splice(response):
+            return complete
+
+        fragments = {None: ''}
+        for key, (fragment, fragment_complete) in zip(distinct_keys, results):
+            fragments[key] = fragment.content
+
+        # Collect the static segments and fragment bodies in order and join
+        # them once at the end.  Rebuilding the content after every tag copies
+        # the whole page once per include.
+        segments = []
+        last_end = 0
+        for tag, key in zip(tags, keys):
+            segments.append(content[last_end:tag.start])
+            segments.append(fragments[key])
+            last_end = tag.end
+        segments.append(content[last_end:])
+        if compress:
+            response.content = gzip_segments(segments)
+        else:
+            response.content = ''.join(segments)
+        return complete
+
+    def stream(self, chunks, render=True):
+        '''
+        Yields the content of chunks with the includes replaced and the rest
+        of the ESI markup removed as they are found.  Markup split across
+        chunks is held back until the rest of it arrives, so only a chunk and
+        a fragment are held in memory at a time.
+
+        The fragments' headers and cookies can't be merged because the
+        response headers are sent before the content.  If render is False the
+        includes are removed instead.
+        '''
+        scanner = Scanner()
+        remainder = ''
+        for chunk in chunks:
+            content = remainder + chunk
+            tags, settled = scanner.scan(content, final=False)
+            for segment in self.stream_segments(content, tags, settled,
+                    render):
+                yield segment
+            remainder = content[settled:]
+        if remainder:
+            tags, settled = scanner.scan(remainder)
+            for segment in self.stream_segments(remainder, tags, settled,
+                    render):
+                yield segment
+
+    def stream_segments(self, content, tags, end, render):
+        last_end = 0
+        for tag in tags:
+            if tag.start > last_end:
+                yield content[last_end:tag.start]
+            key = render and self.include_key(tag)
+            if key:
+                try:
+                    fragment, complete = self.include(key)
+                finally:
+                    self.flush()
+                if fragment.content:
+                    yield fragment.content
+            last_end = tag.end
+        if end > last_end:
+            yield content[last_end:end]
+
+def is_streaming_response(response):
+    '''
+    True for responses that should be assembled while they are sent:
+    StreamingHttpResponse, and HttpResponses created from an iterator when
+    ESI_STREAM_ITERATORS is set.
+    '''
+    if getattr(response, 'streaming', False):
+        return True
+    if not getattr(settings, 'ESI_STREAM_ITERATORS', False):
+        return False
+    # Django 1.3 flags string content, later versions flag iterators.
+    return getattr(response, '_base_content_is_iter',
+        not getattr(response, '_is_string', True))
+
+def stream_esi_tags(request, response):
+    '''
+    Wraps the content iterator of a streaming response so its includes are
+    replaced as it is sent, decompressing and compressing it again on the fly
+    if it has already been gzipped.
+    '''
+    assembler = FragmentAssembler(request)
+    render = response.status_code == 200 or assembler.process_errors
+    is_gzipped = response.get('Content-Encoding', None) == 'gzip'
+
+    if hasattr(response, 'streaming_content'):
+        chunks = response.streaming_content
+    else:
+        chunks = (smart_str(chunk, response._charset)
+            for chunk in response._container)
+    if is_gzipped:
+        chunks = gunzip_chunks(chunks)
+    chunks = assembler.stream(chunks, render)
+    if is_gzipped:
+        chunks = gzip_chunks(chunks)
+
+    if hasattr(response, 'streaming_content'):
+        response.streaming_content = chunks
+    else:
+        response._container = chunks
+    if response.has_header('Content-Length'):
+        del response['Content-Length']
+
+def replace_esi_tags(request, response, compress=False, splice=True):
+    '''
+    Replaces the includes in the response with their fragments.  If compress
+    is True the new content is gzipped a segment at a time, which saves
+    compressing the static text and fragments it has seen recently again.
+
+    With ESI_USE_ETAGS the response is given a composite ETag; see
+    set_composite_etag.  Returns True, leaving the content as it is, if the
+    request's conditional headers show that the client already has the
+    assembled page.  If splice is False the fragments' headers and cookies
+    are merged but the content is left as it is.
+    '''
+    assembler = FragmentAssembler(request)
+    recorded_urls = getattr(request, '_esi', {}).get('urls')
+    render = response.status_code == 200 or assembler.process_errors
+    conditional = assembler.validators is not None and \
+        response.status_code == 200
+    if conditional:
+        page_validator = response.get('ETag', None) or \
+            hashlib.md5(response.content).hexdigest()
+        # Checked before the fragments' Last-Modified headers are merged in.
+        page_last_modified = 'Last-Modified' in response
+    not_modified = []
+
+    def before_splice(response):
+        if conditional:
+            set_composite_etag(response, page_validator, assembler)
+            if is_not_modified(request, response, page_last_modified and
+                    not assembler.missing_last_modified):
+                not_modified.append(True)
+                return False
+        return splice
+
+    assembler.replace_tags(response, max_workers=assembler.max_workers,
+        compress=compress, recorded_urls=recorded_urls, render=render,
+        before_splice=before_splice)
+    if assembler.timings is not None:
+        request._esi.setdefault('timings', {}).setdefault('fragments',
+            []).extend(assembler.timings)
+    return bool(not_modified)
+
+def set_composite_etag(response, page_validator, assembler):
+    '''
+    Sets the ETag of an assembled page from the validators of the page and of
+    every fragment in it: each fragment's ETag, or a digest of its content if
+    it has none.  The ETag changes whenever any part of the page does.
+    '''
+    parts = [page_validator]
+    for url, validator in sorted(assembler.validators.items()):
+        parts.append('%s %s' % (url, validator))
+    response['ETag'] = '"%s"' % hashlib.md5(
+        smart_str('\n'.join(parts))).hexdigest()
+
+def parse_etags(value):
+    '''Returns the entity tags in an If-None-Match header, without W/.'''
+    etags = []
+    for etag in cc_delim_re.split(value or ''):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        if etag:
+            etags.append(etag)
+    return etags
+
+def is_not_modified(request, response, use_last_modified=True):
+    '''
+    True if the request's If-None-Match or If-Modified-Since header shows
+    the client already has the response.  If-Modified-Since is only checked
+    if use_last_modified is True, which it should only be when the page and
+    every fragment in it had a Last-Modified, because one merged from only
+    some of the parts of a page can't show it is unchanged.
+    '''
+    meta = getattr(request, 'META', {})
+    if 'HTTP_IF_NONE_MATCH' in meta:
+        etags = parse_etags(meta['HTTP_IF_NONE_MATCH'])
+        return '*' in etags or response.get('ETag', None) in etags
+    if_modified_since = meta.get('HTTP_IF_MODIFIED_SINCE', None)
+    if not (if_modified_since and use_last_modified and
+            'Last-Modified' in response):
+        return False
+    if_modified_since = parsedate_tz(if_modified_since)
+    last_modified = parsedate_tz(response['Last-Modified'])
+    return bool(if_modified_since and last_modified and
+        mktime_tz(last_modified) <= mktime_tz(if_modified_since))
+
+def render_inline(request, url):
+    '''
+    Returns the content of the fragment at url, assembled for the page request
+    while its template is rendered.  This is the {% esi %} tag's ESI_INLINE
+    mode.
+
+    The fragments of a page share one FragmentAssembler, and each one is
+    recorded in request._esi['inlined'] so IncludeEsiMiddleware can merge its
+    headers and cookies into the page.
+
+    The fragment is handled on the page's thread, and the handler resets the
+    URLconf and its middleware may activate another language, so both are
+    put back for the rest of the page's template.
+    '''
+    esi_status = request._esi
+    assembler = esi_status.get('assembler', None)
+    if assembler is None:
+        assembler = esi_status['assembler'] = FragmentAssembler(request)
+        if assembler.timings is not None:
+            assembler.timings = esi_status.setdefault('timings',
+                {}).setdefault('fragments', [])
+    key = (build_full_fragment_url(request, url), None, False)
+    urlconf = get_urlconf()
+    language = translation.get_language()
+    try:
+        fragment, complete = assembler.include(key)
+    finally:
+        assembler.flush()
+        set_urlconf(urlconf)
+        translation.activate(language)
+    inlined = esi_status.setdefault('inlined', [])
+    if fragment not in inlined:
+        inlined.append(fragment)
+    return fragment.content
@@ -0,0 +1,96 @@
+'''
+Shared setup for the benchmark scripts in this directory.
+
+The scripts are run directly (``python benchmarks/assembly.py``) and configure
+a minimal Django environment around the ``esi_support`` test application so no
+project settings are needed.
+'''
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from django.conf import settings
+
+BENCHMARK_SETTINGS = {
+    'DEBUG': False,
+    # Django 1.5 checks the Host header once DEBUG is off.
+    'ALLOWED_HOSTS': ['*'],
+    'INSTALLED_APPS': (
+        'armstrong.esi',
+        'armstrong.esi.tests.esi_support',
+    ),
+    'TEMPLATE_CONTEXT_PROCESSORS': [
+        'armstrong.esi.context_processors.esi',
+    ],
+    'ROOT_URLCONF': 'armstrong.esi.tests.esi_support.urls',
+    'MIDDLEWARE_CLASSES': [
+        'armstrong.esi.middleware.IncludeEsiMiddleware',
+        'armstrong.esi.middleware.EsiHeaderMiddleware',
+    ],
+}
+
+if not settings.configured:
+    settings.configure(**BENCHMARK_SETTINGS)
+
+from django.http import HttpRequest, HttpResponse
+
+# The expression includes were found with before armstrong.esi.parser.
+legacy_tag_re = re.compile(r'<esi:include src="(?P<url>[^"]+?)"\s*/>', re.I)
+
+
+def make_request(path='/'):
+    '''Builds a bare parent request suitable for ``replace_esi_tags``.'''
+    request = HttpRequest()
+    request.path = request.path_info = path
+    request.META = {'SERVER_NAME': 'example.com', 'SERVER_PORT': '80'}
+    request._esi = {'used': True}
+    return request
+
+
+def best_of(func, repeat=5, number=1):
+    '''
+    Runs ``func`` ``number`` times per round and returns the fastest round,
+    in seconds per call.
+    '''
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        for j in range(number):
+            func()
+        timings.append((time.time() - start) / number)
+    return min(timings)
+
+
+class ConstantClient(object):
+    '''
+    Stands in for http_client.Client so a benchmark measures assembly rather
+    than fragment rendering.  Every fragment is the same block of text.
+    '''
+    fragment = 'f' * 200
+
+    def __init__(self, **defaults):
+        pass
+
+    def get(self, url):
+        return HttpResponse(self.fragment)
+
+
+def sample_text(size, seed=0):
+    '''Returns size bytes of word-like text that compresses like HTML.'''
+    import random
+    rng = random.Random(seed)
+    words = ['<p class="story">', '</p>', 'the', 'council', 'voted', 'on',
+        'budget', 'Austin', 'school', 'district', '<a href="/news/">',
+        '</a>', 'reported', 'Tuesday', 'said', 'mayor']
+    text = []
+    length = 0
+    while length < size:
+        word = rng.choice(words)
+        text.append(word)
+        length += len(word) + 1
+    return ' '.join(text)[:size]
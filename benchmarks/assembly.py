@@ -0,0 +1,62 @@
+'''
+Measures how the cost of splicing fragments into a page grows with page size
+and the number of ``<esi:include>`` tags.
+
+Fragment rendering is replaced with a constant response so the timings only
+reflect the assembly itself.  The quadratic implementation that rebuilt the
+content after every tag is kept here for comparison.
+
+Usage: python benchmarks/assembly.py
+'''
+from _utils import ConstantClient, best_of, legacy_tag_re, make_request
+
+from django.http import HttpResponse
+
+from armstrong.esi import utils
+from armstrong.esi.utils import replace_esi_tags
+
+def legacy_replace_esi_tags(request, response):
+    '''The original splicing loop: one full copy of the page per include.'''
+    replacement_offset = 0
+    for match in legacy_tag_re.finditer(response.content):
+        fragment = ConstantClient().get(match.group('url'))
+        start = match.start() + replacement_offset
+        end = match.end() + replacement_offset
+        response.content = '%s%s%s' % (response.content[:start],
+            fragment.content, response.content[end:])
+        replacement_offset += len(fragment.content) - len(match.group(0))
+
+
+def build_page(size, tags):
+    tag = '<esi:include src="/hello/" />'
+    chunk = 'x' * max((size - tags * len(tag)) // (tags + 1), 0)
+    return chunk + ''.join(tag + chunk for i in range(tags))
+
+
+def run(func, page):
+    request = make_request()
+    response = HttpResponse(page)
+    func(request, response)
+    return response.content
+
+
+def main():
+    original_client = utils.http_client.Client
+    utils.http_client.Client = ConstantClient
+    try:
+        print '%10s %6s %12s %12s' % ('page', 'tags', 'single-pass', 'legacy')
+        for size in (50000, 100000, 300000):
+            for tags in (10, 40, 160):
+                page = build_page(size, tags)
+                assert run(replace_esi_tags, page) == \
+                    run(legacy_replace_esi_tags, page)
+                current = best_of(lambda: run(replace_esi_tags, page))
+                legacy = best_of(lambda: run(legacy_replace_esi_tags, page))
+                print '%10d %6d %10.2fms %10.2fms' % (size, tags,
+                    current * 1000, legacy * 1000)
+    finally:
+        utils.http_client.Client = original_client
+
+
+if __name__ == '__main__':
+    main()
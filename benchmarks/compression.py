@@ -0,0 +1,67 @@
+'''
+Compares the CPU cost of assembling an already gzipped page by
+decompressing, assembling and compressing the whole page again with
+compressing the assembled page a segment at a time (ESI_GZIP_SEGMENTS).
+
+Fragments are constant so the timings reflect the compression work.  Pages
+are assembled repeatedly, as they would be when the same page is requested
+again, so the reuse of recently compressed segments shows up.
+
+Usage: python benchmarks/compression.py
+'''
+from _utils import ConstantClient, best_of, make_request, sample_text
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.middleware.gzip import GZipMiddleware
+
+from armstrong.esi import utils
+from armstrong.esi.middleware import IncludeEsiMiddleware
+
+
+def build_page(size, tags):
+    tag = '<esi:include src="/hello/" />'
+    chunk = max((size - tags * len(tag)) // (tags + 1), 0)
+    return sample_text(chunk, 0) + ''.join(tag + sample_text(chunk, i + 1)
+        for i in range(tags))
+
+
+def assemble(page, segments):
+    settings.ESI_GZIP_SEGMENTS = segments
+    request = make_request()
+    request.META['HTTP_ACCEPT_ENCODING'] = 'gzip'
+    response = GZipMiddleware().process_response(request, HttpResponse(page))
+    start = response.content
+    return lambda: run(request, start)
+
+
+def run(request, compressed):
+    response = HttpResponse(compressed)
+    response['Content-Encoding'] = 'gzip'
+    IncludeEsiMiddleware().process_response(request, response)
+    return response
+
+
+def main():
+    original_client = utils.http_client.Client
+    utils.http_client.Client = ConstantClient
+    try:
+        print '%10s %6s %12s %12s %10s %10s' % ('page', 'tags', 'round trip',
+            'segments', 'bytes', 'bytes')
+        for size in (50000, 200000, 500000):
+            for tags in (10, 40):
+                page = build_page(size, tags)
+                timings = []
+                sizes = []
+                for segments in (False, True):
+                    func = assemble(page, segments)
+                    sizes.append(len(func().content))
+                    timings.append(best_of(func, number=5))
+                print '%10d %6d %10.2fms %10.2fms %10d %10d' % (size, tags,
+                    timings[0] * 1000, timings[1] * 1000, sizes[0], sizes[1])
+    finally:
+        utils.http_client.Client = original_client
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+'''
+Compares the per-fragment overhead of building a new LocalHandler for every
+include, which loads the middleware chain each time, with reusing the shared
+process-wide handler, and with calling the view directly through the
+DirectHandler used by ESI_DIRECT_DISPATCH.
+
+Usage: python benchmarks/handler.py
+'''
+from _utils import best_of
+
+from django.conf import settings
+
+from armstrong.esi import http_client
+
+# A typical project middleware chain, so loading it costs what it would in a
+# real deployment.
+settings.MIDDLEWARE_CLASSES = [
+    'django.middleware.common.CommonMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.middleware.csrf.CsrfViewMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+    'armstrong.esi.middleware.IncludeEsiMiddleware',
+    'armstrong.esi.middleware.EsiHeaderMiddleware',
+]
+
+URL = '/hello/'
+META = {'SERVER_NAME': 'example.com', 'SERVER_PORT': '80'}
+NUMBER = 500
+
+
+def per_fragment_handler():
+    http_client.Client().get(URL)
+
+
+def shared_handler():
+    http_client.Client(handler=http_client.local_handler).get(URL)
+
+
+def direct_dispatch():
+    request = http_client.fragment_request(URL, {}, META)
+    http_client.direct_handler(request)
+
+
+def main():
+    for name, func in (('new handler per fragment', per_fragment_handler),
+            ('shared handler', shared_handler),
+            ('direct dispatch', direct_dispatch)):
+        func()
+        timing = best_of(func, number=NUMBER)
+        print '%-26s %8.1fus per fragment' % (name, timing * 1000000)
+
+
+if __name__ == '__main__':
+    main()
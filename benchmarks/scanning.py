@@ -0,0 +1,45 @@
+'''
+Compares the ways of finding the includes on a page: the regular expression
+used before the tokenizer, the tokenizer in ``armstrong.esi.parser``, and
+the URLs the ``{% esi %}`` template tag recorded while rendering the page.
+
+Usage: python benchmarks/scanning.py
+'''
+from _utils import best_of, legacy_tag_re
+
+from armstrong.esi.parser import esi_tmpl, parse
+from armstrong.esi.utils import find_esi_tags
+
+
+def build_page(size, tags):
+    urls = ['/fragment/%d/' % i for i in range(tags)]
+    # Ordinary markup, so the scanners have plenty of '<' to look at.
+    chunk = '<p><a href="/">x</a></p>' * max(size // (tags + 1) // 24, 1)
+    return chunk + ''.join(esi_tmpl % url + chunk for url in urls), urls
+
+
+def regex(page):
+    return [(match.start(), match.end(), match.group('url'))
+        for match in legacy_tag_re.finditer(page)]
+
+
+def main():
+    print '%10s %6s %12s %12s %12s' % ('page', 'tags', 'recorded',
+        'tokenizer', 'regex')
+    for size in (200000, 1000000, 5000000):
+        for tags in (10, 100, 1000):
+            page, urls = build_page(size, tags)
+            expected = regex(page)
+            assert [tuple(tag[:3]) for tag in parse(page)] == expected
+            assert [tuple(tag[:3]) for tag in find_esi_tags(page, urls)] == \
+                expected
+            timings = [best_of(func, number=10) for func in (
+                lambda: find_esi_tags(page, urls),
+                lambda: parse(page),
+                lambda: regex(page))]
+            print '%10d %6d %10.3fms %10.3fms %10.3fms' % ((size, tags) +
+                tuple(timing * 1000 for timing in timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+'''
+Benchmarks each stage of the ESI assembly pipeline against the ``esi_support``
+test views, and writes the results as JSON so runs can be compared between
+releases.
+
+Usage: python benchmarks/suite.py [options]
+
+    --page-size BYTES       size of the static text on the page
+    --includes N            number of <esi:include> tags on the page
+    --fragment-size BYTES   size of each fragment
+    --duplicate-ratio R     fraction of the includes that repeat an earlier
+                            URL, from 0 to 1
+    --only NAME             run only the named benchmarks (repeatable)
+    --json FILE             write the results to FILE
+    --baseline FILE         compare with the results in FILE, exiting with
+                            status 1 if any benchmark is slower by more than
+                            --tolerance (a fraction, default 0.2)
+
+Run ``python benchmarks/suite.py --help`` for the full list.
+'''
+import argparse
+import json
+import platform
+import sys
+
+from _utils import best_of, make_request, sample_text
+
+import django
+from django.conf import settings
+from django.http import HttpResponse, SimpleCookie
+from django.middleware.gzip import GZipMiddleware
+from django.template import Context, Template
+from django.utils.datastructures import MultiValueDict
+from django.utils.http import http_date
+
+from armstrong.esi import context_processors, http_client
+from armstrong.esi.middleware import IncludeEsiMiddleware
+from armstrong.esi.utils import merge_fragment_cookies, \
+    merge_fragment_headers, replace_esi_tags
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    '''
+    Registers a benchmark.  func takes the parsed options and returns a
+    callable that runs it once, along with the number of operations each run
+    performs.
+    '''
+    BENCHMARKS.append(func)
+    return func
+
+
+def include_urls(options):
+    '''The fragment URL for each include, repeating URLs as asked.'''
+    distinct = max(int(round(options.includes *
+        (1 - options.duplicate_ratio))), 1)
+    return ['/sized/%d/%d/' % (options.fragment_size, i % distinct)
+        for i in range(options.includes)]
+
+
+def build_page(options):
+    tags = ['<esi:include src="%s" />' % url for url in include_urls(options)]
+    chunk = options.page_size // (len(tags) + 1)
+    return sample_text(chunk, 0) + ''.join(tag + sample_text(chunk, i + 1)
+        for i, tag in enumerate(tags))
+
+
+@benchmark
+def replace_tags(options):
+    page = build_page(options)
+
+    def run():
+        replace_esi_tags(make_request(), HttpResponse(page))
+    return run, options.includes
+
+
+@benchmark
+def middleware(options):
+    page = build_page(options)
+
+    def run():
+        IncludeEsiMiddleware().process_response(make_request(),
+            HttpResponse(page))
+    return run, options.includes
+
+
+def gzipped_page(options, segments):
+    '''
+    Returns a callable that assembles the page after GZipMiddleware has
+    compressed it, with or without ESI_GZIP_SEGMENTS.  The request accepts
+    gzip, so the assembled page is compressed again.
+    '''
+    request = make_request()
+    request.META['HTTP_ACCEPT_ENCODING'] = 'gzip'
+    compressed = GZipMiddleware().process_response(request,
+        HttpResponse(build_page(options))).content
+
+    def run():
+        original = getattr(settings, 'ESI_GZIP_SEGMENTS', False)
+        settings.ESI_GZIP_SEGMENTS = segments
+        try:
+            response = HttpResponse(compressed)
+            response['Content-Encoding'] = 'gzip'
+            response = IncludeEsiMiddleware().process_response(request,
+                response)
+        finally:
+            settings.ESI_GZIP_SEGMENTS = original
+        assert response['Content-Encoding'] == 'gzip'
+    return run
+
+
+@benchmark
+def middleware_gzip(options):
+    return gzipped_page(options, False), options.includes
+
+
+@benchmark
+def middleware_gzip_segments(options):
+    return gzipped_page(options, True), options.includes
+
+
+@benchmark
+def merge_headers(options):
+    fragment_headers = MultiValueDict()
+    for i in range(options.includes):
+        fragment_headers.appendlist('Vary', 'Cookie, Accept-Language')
+        fragment_headers.appendlist('Last-Modified', http_date(1000000 + i))
+
+    def run():
+        response = HttpResponse()
+        response['Vary'] = 'Accept-Encoding'
+        merge_fragment_headers(response, fragment_headers.copy())
+    return run, options.includes
+
+
+@benchmark
+def merge_cookies(options):
+    fragment_cookies = []
+    for i in range(options.includes):
+        cookies = SimpleCookie()
+        for name in ('a', 'b', 'fragment-%d' % i):
+            cookies[name] = str(i)
+        fragment_cookies.append(cookies)
+
+    def run():
+        merge_fragment_cookies(HttpResponse(), fragment_cookies)
+    return run, options.includes
+
+
+@benchmark
+def client_get(options):
+    url = include_urls(options)[0]
+
+    def run():
+        http_client.Client(handler=http_client.local_handler).get(url)
+    return run, 1
+
+
+@benchmark
+def esi_node_render(options):
+    template = Template('{% load esi %}{% for number in numbers %}'
+        '{% esi sized size=size number=number %}{% endfor %}')
+    numbers = range(options.includes)
+
+    def run():
+        request = make_request()
+        del request._esi
+        context = Context(context_processors.esi(request))
+        context.update({'numbers': numbers, 'size': options.fragment_size})
+        template.render(context)
+    return run, options.includes
+
+
+def run_benchmarks(options):
+    results = {}
+    for func in BENCHMARKS:
+        if options.only and func.__name__ not in options.only:
+            continue
+        run, operations = func(options)
+        run()
+        seconds = best_of(run, repeat=options.repeat, number=options.number)
+        results[func.__name__] = {
+            'seconds': seconds,
+            'operations': operations,
+            'seconds_per_operation': seconds / max(operations, 1),
+        }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''Returns the names of the benchmarks slower than in baseline.'''
+    regressions = []
+    for name, result in sorted(results.items()):
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        change = result['seconds'] / previous['seconds'] - 1
+        print '%-24s %+7.1f%%' % (name, change * 100)
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the ESI assembly pipeline.')
+    parser.add_argument('--page-size', type=int, default=100000)
+    parser.add_argument('--includes', type=int, default=40)
+    parser.add_argument('--fragment-size', type=int, default=500)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.25)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=5)
+    parser.add_argument('--only', action='append',
+        choices=[func.__name__ for func in BENCHMARKS])
+    parser.add_argument('--json', metavar='FILE')
+    parser.add_argument('--baseline', metavar='FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    options = parser.parse_args(args)
+    if not 0 <= options.duplicate_ratio <= 1:
+        parser.error('--duplicate-ratio must be between 0 and 1')
+    if options.includes < 1:
+        parser.error('--includes must be at least 1')
+    return options
+
+
+def main(args=None):
+    options = parse_args(args)
+    results = run_benchmarks(options)
+
+    print '%-24s %12s %16s' % ('benchmark', 'per run', 'per operation')
+    for name, result in sorted(results.items()):
+        print '%-24s %10.3fms %14.1fus' % (name, result['seconds'] * 1000,
+            result['seconds_per_operation'] * 1000000)
+
+    report = {
+        'parameters': dict((name, getattr(options, name)) for name in (
+            'page_size', 'includes', 'fragment_size', 'duplicate_ratio',
+            'repeat', 'number')),
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    if options.json:
+        with open(options.json, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('parameters') != report['parameters']:
+            print 'warning: the baseline was run with different parameters'
+        regressions = compare(results, baseline, options.tolerance)
+        if regressions:
+            print 'slower than the baseline: %s' % ', '.join(regressions)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+'''
+Measures rendering templates with hundreds of ``{% esi %}`` tags, such as a
+section front with a teaser include per story, with the tag's memoized URL
+reversal and with a full ``reverse()`` on every render.
+
+Usage: python benchmarks/templatetag.py
+'''
+from _utils import best_of, make_request
+
+from django.template import Context, Template
+
+from armstrong.esi import context_processors
+from armstrong.esi.parser import esi_tmpl
+from armstrong.esi.templatetags.esi import EsiNode
+
+TEMPLATES = (
+    ('literal', '{% load esi %}{% for story in stories %}'
+        '{% esi hello_world %}{% endfor %}'),
+    ('per story', '{% load esi %}{% for story in stories %}'
+        '{% esi hello_number number=story %}{% endfor %}'),
+)
+
+
+def uncached_reverse(self, context):
+    url = self.reverse_uncached(context)
+    return url, esi_tmpl % url
+
+
+def render(template, stories):
+    request = make_request()
+    del request._esi
+    context = Context(context_processors.esi(request))
+    context['stories'] = stories
+    return template.render(context)
+
+
+def main():
+    memoized_reverse = EsiNode.reverse
+    print '%-10s %6s %12s %12s' % ('template', 'tags', 'memoized', 'reverse')
+    for name, source in TEMPLATES:
+        template = Template(source)
+        for count in (100, 500):
+            stories = range(count)
+            timings = []
+            for reverse in (memoized_reverse, uncached_reverse):
+                EsiNode.reverse = reverse
+                try:
+                    timings.append(best_of(lambda: render(template, stories)))
+                finally:
+                    EsiNode.reverse = memoized_reverse
+            print '%-10s %6d %10.2fms %10.2fms' % (name, count,
+                timings[0] * 1000, timings[1] * 1000)
+
+
+if __name__ == '__main__':
+    main()